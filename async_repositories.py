@@ -0,0 +1,184 @@
+from sqlalchemy import select
+
+from shopping_cart import CartVersion, ModelNotFoundException, ShoppingCart
+from repositories import (InvalidQuantityException, ProductAlreadyInShoppingCartException,
+                          UserDoesNotHaveAShoppingCartException, add_product_statement,
+                          add_snapshot_statement, bump_cart_version_statement, cart_line,
+                          cart_line_serializer, cart_lines_statement, cart_summary, cart_summary_statement,
+                          cart_totals_delta_statement, change_quantity_statement, delete_cart_statement,
+                          delete_cart_totals_statement, delete_orphan_snapshots_statement, delete_product_statement,
+                          find_snapshot_statement, has_shopping_cart_statement, serialize_cart_summary,
+                          validate_quantity)
+
+#
+# Async counterparts of the repositories in `repositories.py`, used by the ASGI app.
+# They follow the same rules and raise the same exceptions with the same messages.
+#
+
+
+class AsyncShoppingCartRepository():
+    @classmethod
+    async def create(cls, db_session, catalog, user_id: int):
+        """
+         Validate the required arguments and initialize the required properties
+        """
+        self = cls()
+
+        # Make sure the user exists before continuing
+        try:
+            user = await catalog.get_single_user(user_id)
+        except ModelNotFoundException:
+            raise ModelNotFoundException(f"User #{user_id} does not exist!", 404)
+
+        # Make sure the user got at least 1 shopping cart instance
+        if await _first(db_session, user_id=user_id) == None:
+            raise UserDoesNotHaveAShoppingCartException(f"User #{user_id} does not have any shopping carts!")
+
+        self._session = db_session
+        self._user_id = user_id
+        self._user    = user
+        return self
+
+
+    async def get(self):
+        """
+         Show user's shopping cart
+        """
+        query, serialize = cart_lines_statement(self._user_id, self._user['username'])
+        result           = await self._session.execute(query)
+        return [serialize(row) for row in result.all()]
+
+
+    async def summary(self):
+        """
+         Item count, total quantity and total value of user's shopping cart, read from its totals row
+        """
+        totals = (await self._session.execute(cart_summary_statement(self._user_id))).first()
+        return serialize_cart_summary(cart_summary(self._user_id, totals))
+
+
+    async def delete(self):
+        """
+         Delete user's shopping cart, every line of it in one statement
+        """
+        snapshot_ids = set((await self._session.execute(delete_cart_statement(self._user_id))).scalars())
+        await self._session.execute(delete_orphan_snapshots_statement(snapshot_ids))
+        await self._session.execute(delete_cart_totals_statement(self._user_id))
+        await self._session.execute(bump_cart_version_statement(self._user_id))
+        await self._session.commit()
+        return 204
+
+
+
+class AsyncProductRepository():
+    @classmethod
+    async def create(cls, db_session, catalog, user_id: int, product_id: int):
+        """
+         Validate the required arguments and initialize the required properties
+
+         @throws ModelNotFound
+        """
+        self = cls()
+
+        # Make sure both the user and the product exist before continuing, they're fetched at the same time
+        user, product = await catalog.get_user_and_product(user_id, product_id)
+
+        self._session    = db_session
+        self._user_id    = user_id
+        self._product_id = product_id
+        self._product    = product
+        self._user       = user
+        return self
+
+
+    async def add(self):
+        """
+         Add the product to the user's shopping cart
+
+         @throws ProductAlreadyInShoppingCart
+        """
+        snapshot_id = (await self._session.execute(add_snapshot_statement(self._product_id, self._product))).scalar() \
+            or (await self._session.execute(find_snapshot_statement(self._product_id, self._product))).scalar()
+
+        new_product = (await self._session.execute(add_product_statement(self._user_id, self._product_id, snapshot_id))).first()
+
+        if new_product == None:
+            await self._session.rollback()
+            raise ProductAlreadyInShoppingCartException(f"Product #{self._product_id} is already in user #{self._user_id}'s shopping cart!")
+
+        await self._session.execute(cart_totals_delta_statement(self._user_id, self._product_id, 1, ShoppingCart.quantity))
+        await self._session.execute(bump_cart_version_statement(self._user_id))
+        await self._session.commit()
+
+        return cart_line_serializer()(cart_line(new_product, self._user, self._product))
+
+
+    async def delete(self):
+        """
+         Delete the product from the user's shopping cart
+
+         @throws UserDoesNotHaveAShoppingCart
+        """
+        await self._session.execute(cart_totals_delta_statement(self._user_id, self._product_id, -1, -ShoppingCart.quantity))
+        snapshot_id = (await self._session.execute(delete_product_statement(self._user_id, self._product_id))).scalar()
+
+        if snapshot_id is None:
+            await self._session.rollback()
+            await self._raise_missing_product()
+
+        await self._session.execute(delete_orphan_snapshots_statement({snapshot_id}))
+        await self._session.execute(bump_cart_version_statement(self._user_id))
+        await self._session.commit()
+
+        return 204
+
+
+    async def change_quantity(self, quantity: int):
+        """
+         Change the quantity of a specific product from a specific user's shopping cart
+
+         @throws UserDoesNotHaveAShoppingCart
+        """
+        # Validate quantity
+        try:
+            validate_quantity(quantity)
+        except InvalidQuantityException:
+            if not await self._has_shopping_cart():
+                raise UserDoesNotHaveAShoppingCartException(f"User #{self._user_id} does not have any shopping cart instances!")
+            raise
+
+        await self._session.execute(cart_totals_delta_statement(self._user_id, self._product_id, 0, quantity - ShoppingCart.quantity))
+        result = await self._session.execute(change_quantity_statement(self._user_id, self._product_id, quantity))
+
+        if result.rowcount == 0:
+            await self._session.rollback()
+            await self._raise_missing_product()
+
+        await self._session.execute(bump_cart_version_statement(self._user_id))
+        await self._session.commit()
+
+        return 200
+
+
+    async def _has_shopping_cart(self) -> bool:
+        return (await self._session.execute(has_shopping_cart_statement(self._user_id))).scalar()
+
+
+    async def _raise_missing_product(self):
+        if not await self._has_shopping_cart():
+            raise UserDoesNotHaveAShoppingCartException(f"User #{self._user_id} does not have any shopping cart instances!")
+
+        raise ModelNotFoundException(f"Product #{self._product_id} does not exist in user #{self._user_id}'s shopping cart!")
+
+
+
+async def get_cart_version(db_session, user_id: int) -> int:
+    """
+     Current version of a user's shopping cart, 0 when it was never changed
+    """
+    return (await db_session.execute(select(CartVersion.version).where(CartVersion.user_id == user_id))).scalar() or 0
+
+
+async def _first(db_session, **criteria):
+    result = await db_session.scalars(select(ShoppingCart).filter_by(**criteria).limit(1))
+    return result.first()
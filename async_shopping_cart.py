@@ -0,0 +1,311 @@
+"""
+ ASGI entry point of the shopping cart API
+
+ Serves the same routes, status codes and messages as `shopping_cart.py`, but catalog calls go
+ through a non-blocking HTTP client and the database through aiosqlite, so a single process can
+ keep thousands of cart requests in flight.
+
+ Run with: hypercorn async_shopping_cart:app
+"""
+import asyncio
+
+from quart import Quart, make_response, request
+from quart_cors import cors
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from async_repositories import AsyncProductRepository, AsyncShoppingCartRepository, get_cart_version
+from repositories import (InvalidQuantityException, ProductAlreadyInShoppingCartException,
+                          UserDoesNotHaveAShoppingCartException)
+import shopping_cart
+from shopping_cart import ModelNotFoundException, db
+from cache import TTLCache
+from logger import get_request_id, logger_factory, set_request_id
+from serialization import MSGPACK_MIMETYPE, dumps_json, dumps_msgpack, msgpack
+from storage import configure_engine
+from upstream import AsyncUpstreamClient, UpstreamUnavailableException
+
+
+app = Quart(__name__)
+app = cors(app, allow_origin="*")
+logger = logger_factory(__name__)
+
+# Same database files as the sync app, through the aiosqlite driver. The carts are in the shards when
+# there are some, the catalog isn't read from the database here.
+engines = [create_async_engine(sync_engine.url.set(drivername='sqlite+aiosqlite'))
+           for sync_engine in (shopping_cart.shards.engines if shopping_cart.shards is not None else [db.engine])]
+for engine in engines:
+    configure_engine(engine.sync_engine, shopping_cart.app.config['CART_STORAGE_MODE'])
+sessions = [async_sessionmaker(engine, expire_on_commit=False) for engine in engines]
+
+
+def cart_session(user_id: int):
+    """
+     New session on the database holding the user's shopping cart
+    """
+    return sessions[shopping_cart.shards.shard_for(user_id) if shopping_cart.shards is not None else 0]()
+
+
+class AsyncCatalog():
+    def __init__(self):
+        """
+         Non-blocking, cached access to the users/products API
+        """
+        self.client        = AsyncUpstreamClient('catalog', pool_size=100, connect_timeout=3.05, read_timeout=10, retries=2)
+        self.user_cache    = TTLCache(maxsize=10000, ttl=300, negative_ttl=30)
+        self.product_cache = TTLCache(maxsize=10000, ttl=300, negative_ttl=30)
+
+
+    async def get_single_product(self, product_id):
+        return await self.product_cache.aget_or_load(int(product_id), lambda: self._fetch_single_product(product_id),
+                                                     negative=ModelNotFoundException)
+
+
+    async def get_single_user(self, user_id):
+        return await self.user_cache.aget_or_load(int(user_id), lambda: self._fetch_single_user(user_id),
+                                                  negative=ModelNotFoundException)
+
+
+    async def get_user_and_product(self, user_id, product_id):
+        """
+         Fetch a user and a product at the same time, errors about the user take precedence
+        """
+        user, product = await asyncio.gather(self.get_single_user(user_id), self.get_single_product(product_id),
+                                             return_exceptions=True)
+        for result in (user, product):
+            if isinstance(result, BaseException):
+                raise result
+
+        return user, product
+
+
+    async def _fetch_single_product(self, product_id):
+        r = await self.client.get(shopping_cart.get_single_product_url + str(product_id))
+
+        if r.content == b'' or r.content == 'null':
+            raise ModelNotFoundException(f"Product #{product_id} does not exist!")
+
+        return r.json()
+
+
+    async def _fetch_single_user(self, user_id):
+        r = await self.client.get(shopping_cart.get_single_user_url + str(user_id))
+
+        if r.content == b'' or r.content == 'null':
+            raise ModelNotFoundException(f"User #{user_id} does not exist!")
+
+        return r.json()
+
+
+catalog = AsyncCatalog()
+
+# Bodies are JSON, or MessagePack when the client prefers it, like the representations of the sync app
+FORMATS = {'application/json': dumps_json}
+if msgpack is not None:
+    FORMATS[MSGPACK_MIMETYPE] = dumps_msgpack
+
+
+def negotiated_mimetype() -> str:
+    return request.accept_mimetypes.best_match(list(FORMATS), default='application/json')
+
+
+def cart_etag(user_id: int, version: int, mimetype: str) -> str:
+    """
+     Same tag as the sync app, every format of a cart version is a representation of its own
+    """
+    return f"{user_id}-{version}-{'msgpack' if mimetype == MSGPACK_MIMETYPE else 'json'}"
+
+
+async def not_modified(etag: str):
+    response = await make_response('', 304)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+
+async def render(data, mimetype: str):
+    response = await make_response(FORMATS[mimetype](data), 200)
+    response.mimetype = mimetype
+    response.vary.add('Accept')
+    return response
+
+
+@app.before_request
+async def tag_request():
+    request_id = request.headers.get('X-Request-ID', '')
+    set_request_id(request_id if shopping_cart.REQUEST_ID_PATTERN.fullmatch(request_id) else None)
+
+
+@app.after_request
+async def add_request_id(response):
+    response.headers['X-Request-ID'] = get_request_id()
+    return response
+
+
+@app.route('/cart/user/<int:user_id>', methods=['GET'])
+async def get_shopping_cart(user_id: int):
+    """
+    Return the entire shopping cart of a specific user
+    """
+    async with cart_session(user_id) as session:
+        try:
+            repository = await AsyncShoppingCartRepository.create(session, catalog, user_id)
+            mimetype   = negotiated_mimetype()
+            etag       = cart_etag(user_id, await get_cart_version(session, user_id), mimetype)
+
+            if request.if_none_match.contains_weak(etag):
+                return await not_modified(etag)
+
+            response = await repository.get()
+
+        except UserDoesNotHaveAShoppingCartException as e:
+            return await make_response(str(e), 404)
+
+        except ModelNotFoundException as e:
+            return await make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return await make_response(str(e), 503)
+
+    response = await render(response, mimetype)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/cart/user/<int:user_id>/summary', methods=['GET'])
+async def get_shopping_cart_summary(user_id: int):
+    """
+     Item count, total quantity and total value of a specific user's shopping cart, without its lines
+    """
+    async with cart_session(user_id) as session:
+        try:
+            repository = await AsyncShoppingCartRepository.create(session, catalog, user_id)
+            mimetype   = negotiated_mimetype()
+            etag       = cart_etag(user_id, await get_cart_version(session, user_id), mimetype)
+
+            if request.if_none_match.contains_weak(etag):
+                return await not_modified(etag)
+
+            response = await repository.summary()
+
+        except UserDoesNotHaveAShoppingCartException as e:
+            return await make_response(str(e), 404)
+
+        except ModelNotFoundException as e:
+            return await make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return await make_response(str(e), 503)
+
+    response = await render(response, mimetype)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/cart/user/<int:user_id>', methods=['DELETE'])
+async def delete_shopping_cart(user_id: int):
+    """
+     Delete the entire shopping cart of a specific user
+    """
+    async with cart_session(user_id) as session:
+        try:
+            await (await AsyncShoppingCartRepository.create(session, catalog, user_id)).delete()
+        except UserDoesNotHaveAShoppingCartException as e:
+            return await make_response(str(e), 404)
+        except ModelNotFoundException as e:
+            return await make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return await make_response(str(e), 503)
+
+    return await make_response(f"Shopping cart of user #{user_id} has been deleted!", 204)
+
+
+@app.route('/cart/user/<int:user_id>/product/<int:product_id>', methods=['POST'])
+async def add_product(user_id: int, product_id: int):
+    """
+     Add a specific product to a specific user's shopping cart
+    """
+    async with cart_session(user_id) as session:
+        try:
+            await (await AsyncProductRepository.create(session, catalog, user_id, product_id)).add()
+        except ModelNotFoundException as e:
+            return await make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return await make_response(str(e), 503)
+
+        except ProductAlreadyInShoppingCartException as e:
+            return await make_response(str(e), 400)
+
+        except UserDoesNotHaveAShoppingCartException as e:
+            return await make_response(str(e), 400)
+
+    return await make_response(f"Product #{product_id} has been added to user #{user_id}'s shopping cart!", 201)
+
+
+@app.route('/cart/user/<int:user_id>/product/<int:product_id>', methods=['DELETE'])
+async def delete_product(user_id: int, product_id: int):
+    """
+     Delete a specific product from a specific user's shopping cart
+    """
+    async with cart_session(user_id) as session:
+        try:
+            await (await AsyncProductRepository.create(session, catalog, user_id, product_id)).delete()
+        except ModelNotFoundException as e:
+            return await make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return await make_response(str(e), 503)
+
+        except ProductAlreadyInShoppingCartException as e:
+            return await make_response(str(e), 400)
+
+        except UserDoesNotHaveAShoppingCartException as e:
+            return await make_response(str(e), 400)
+
+    return await make_response(f"Product #{product_id} has been deleted from user #{user_id}'s shopping cart!", 204)
+
+
+@app.route('/cart/user/<int:user_id>/product/<int:product_id>', methods=['PUT'])
+async def change_product_quantity(user_id: int, product_id: int):
+    """
+     Change the quantity of a specific product from a specific user's shopping cart
+    """
+    quantity = (await request.get_json())['quantity']
+
+    async with cart_session(user_id) as session:
+        try:
+            await (await AsyncProductRepository.create(session, catalog, user_id, product_id)).change_quantity(quantity)
+        except ModelNotFoundException as e:
+            return await make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return await make_response(str(e), 503)
+
+        except ProductAlreadyInShoppingCartException as e:
+            return await make_response(str(e), 400)
+
+        except UserDoesNotHaveAShoppingCartException as e:
+            return await make_response(str(e), 400)
+
+        except InvalidQuantityException as e:
+            return await make_response(str(e), 400)
+
+    return await make_response(f"Product #{product_id} has been updated in user #{user_id}'s shopping cart!", 200)
+
+
+@app.before_serving
+async def startup():
+    shopping_cart.migrate_databases()
+    shopping_cart.start_background_jobs()
+
+
+@app.after_serving
+async def shutdown():
+    await catalog.client.aclose()
+    for engine in engines:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,259 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stub_catalog import add_arguments, start_stub
+
+#
+# Load test of the cart API against a stub catalog
+#
+#   python -m bench.run --users 200 --items 20 --latency-ms 30 --concurrency 32 --duration 15
+#
+# Starts the stub catalog, seeds a database, serves the app in a subprocess and runs every workload
+# for --duration seconds. Throughput and p50/p95/p99 latencies are written to --output as JSON.
+#
+
+
+class Workload():
+    def __init__(self, users: int, items: int, products: int):
+        """
+         Scripted requests over HandleShoppingCart / HandleProduct, one instance per client thread
+        """
+        self.users    = users
+        self.items    = items
+        self.products = products
+        self.etags    = {}
+
+
+    def read_poll(self, session, base_url, rng):
+        """
+         Clients polling their cart, revalidating with the last ETag they got
+        """
+        user_id = rng.randint(1, self.users)
+        headers = {'If-None-Match': self.etags[user_id]} if user_id in self.etags else {}
+
+        r = session.get(f"{base_url}cart/user/{user_id}", headers=headers)
+        if r.status_code == 200 and 'ETag' in r.headers:
+            self.etags[user_id] = r.headers['ETag']
+        return [r]
+
+
+    def read_full(self, session, base_url, rng):
+        """
+         Full cart downloads, no revalidation
+        """
+        return [session.get(f"{base_url}cart/user/{rng.randint(1, self.users)}")]
+
+
+    def churn(self, session, base_url, rng):
+        """
+         Add a product that isn't part of the seeded carts and remove it again
+        """
+        user_id    = rng.randint(1, self.users)
+        product_id = rng.randint(self.items + 1, self.products)
+        url        = f"{base_url}cart/user/{user_id}/product/{product_id}"
+
+        return [session.post(url), session.delete(url)]
+
+
+    def quantity(self, session, base_url, rng):
+        """
+         Quantity updates of seeded cart lines
+        """
+        user_id    = rng.randint(1, self.users)
+        product_id = rng.randint(1, self.items)
+
+        return [session.put(f"{base_url}cart/user/{user_id}/product/{product_id}", json={'quantity': rng.randint(1, 10)})]
+
+
+WORKLOADS = ('read_poll', 'read_full', 'churn', 'quantity')
+
+
+def percentile(samples: list, p: float) -> float:
+    if not samples:
+        return None
+    index = min(len(samples) - 1, max(0, int(round(p / 100 * len(samples))) - 1))
+    return samples[index]
+
+
+def run_workload(name: str, base_url: str, args) -> dict:
+    """
+     Run one workload with --concurrency client threads for --duration seconds
+    """
+    latencies, statuses, errors = [], {}, []
+    body_bytes = []
+    lock     = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def client(seed_value):
+        rng      = random.Random(seed_value)
+        session  = requests.Session()
+        session.headers.update(args.header)
+        workload = Workload(args.users, args.items, args.products)
+        step     = getattr(workload, name)
+
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                responses = step(session, base_url, rng)
+            except requests.RequestException as e:
+                with lock:
+                    errors.append(type(e).__name__)
+                continue
+
+            # Multi request steps are timed as a whole and split evenly
+            elapsed = (time.perf_counter() - started) * 1000 / len(responses)
+            with lock:
+                for r in responses:
+                    latencies.append(elapsed)
+                    statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+                    # As sent, before requests decompresses it
+                    if 'Content-Length' in r.headers:
+                        body_bytes.append(int(r.headers['Content-Length']))
+
+    threads = [threading.Thread(target=client, args=(args.seed + i,)) for i in range(args.concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    server_errors = sum(count for status, count in statuses.items() if status >= 500)
+
+    return {
+        'requests':       len(latencies),
+        'duration_s':     round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms':         round(percentile(latencies, 50), 2) if latencies else None,
+        'p95_ms':         round(percentile(latencies, 95), 2) if latencies else None,
+        'p99_ms':         round(percentile(latencies, 99), 2) if latencies else None,
+        'max_ms':         round(latencies[-1], 2) if latencies else None,
+        'avg_body_bytes': round(sum(body_bytes) / len(body_bytes)) if body_bytes else None,
+        'status_counts':  {str(status): count for status, count in sorted(statuses.items())},
+        'errors':         server_errors + len(errors),
+    }
+
+
+def start_server(port: int, env: dict):
+    process = subprocess.Popen([sys.executable, '-m', 'bench.serve', '--port', str(port)], cwd=ROOT, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited early:\n{process.stdout.read()}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError("The server didn't start within 30 seconds")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cart API against a stub catalog")
+    add_arguments(parser)
+    parser.add_argument('--items', type=int, default=10, help="seeded items per cart")
+    parser.add_argument('--concurrency', type=int, default=16, help="client threads")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per workload")
+    parser.add_argument('--warmup', type=float, default=2, help="seconds of read_full before measuring")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS))
+    parser.add_argument('--seed', type=int, default=42, help="random seed of the clients")
+    parser.add_argument('--db', default=None, help="database file, a temporary one by default")
+    parser.add_argument('--url', default=None, help="benchmark an already running server instead, "
+                                                    "it must use the same catalog and seeded database")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra environment for the server, e.g. CART_STORAGE_MODE=production")
+    parser.add_argument('--header', action='append', default=[], metavar='NAME: VALUE',
+                        help="extra request header of the clients, e.g. 'Accept-Encoding: gzip'")
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+    args.header = [(name.strip(), value.strip()) for name, value in (header.split(':', 1) for header in args.header)]
+
+    if args.products <= args.items:
+        parser.error("--products must be greater than --items, churn uses products outside the seeded carts")
+
+    workloads = [name.strip() for name in args.workloads.split(',') if name.strip()]
+    unknown   = [name for name in workloads if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"Unknown workloads: {', '.join(unknown)}")
+
+    server  = None
+    seeded  = None
+    results = {}
+
+    stub, catalog, catalog_url = start_stub(users=args.users, products=args.products, desc_size=args.desc_size,
+                                            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/') + '/'
+        else:
+            db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='cart-bench-'), 'bench.sqlite3')
+            # Seeded in a subprocess, importing the app here would tie this process to its configuration
+            seeded  = subprocess.run([sys.executable, '-c', f"import json; from bench.seed import seed; print(json.dumps(seed("
+                                      f"{db_path!r}, {args.users}, {args.items}, {args.desc_size})))"],
+                                     cwd=ROOT, check=True, capture_output=True, text=True).stdout.strip().splitlines()[-1]
+            seeded  = json.loads(seeded)
+
+            env = dict(os.environ, CATALOG_API_URL=catalog_url, CART_DATABASE_URI='sqlite:///' + os.path.abspath(db_path))
+            env.update(item.split('=', 1) for item in args.env)
+
+            port     = free_port()
+            server   = start_server(port, env)
+            base_url = f"http://127.0.0.1:{port}/"
+
+        if args.warmup:
+            run_workload('read_full', base_url, argparse.Namespace(**{**vars(args), 'duration': args.warmup}))
+
+        for name in workloads:
+            catalog_requests = catalog.requests
+            results[name]    = run_workload(name, base_url, args)
+            results[name]['catalog_requests'] = catalog.requests - catalog_requests
+            print(f"{name:10} {results[name]['throughput_rps']:>9} req/s  p50 {results[name]['p50_ms']} ms  "
+                  f"p95 {results[name]['p95_ms']} ms  p99 {results[name]['p99_ms']} ms  errors {results[name]['errors']}  {results[name]['avg_body_bytes']} B/response")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        stub.shutdown()
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':    platform.python_version(),
+        'platform':  platform.platform(),
+        'config':    {key: value for key, value in vars(args).items() if key != 'output'},
+        'seed':      seeded,
+        'workloads': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import datetime
+import os
+import sys
+
+from sqlalchemy import insert
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#
+# Creates a shopping cart database of `users` x `items` cart lines for benchmarks
+#
+# Every user gets products 1..items, so their details match the stub catalog.
+#
+
+
+def seed(db_path: str, users: int = 100, items: int = 10, desc_size: int = 200) -> dict:
+    """
+     Create a fresh database at `db_path` with the latest schema and the seeded carts
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    os.environ['CART_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(db_path)
+    sys.path.insert(0, ROOT)
+
+    from bench.stub_catalog import make_product
+    from migrations import add_cart_totals, migrate
+    from shopping_cart import CartVersion, ProductSnapshot, ShoppingCart, db
+    import repositories
+
+    migrate(db.engine, db.metadata)
+
+    now       = datetime.datetime.now()
+    snapshots = []
+    for product_id in range(1, items + 1):
+        product = make_product(product_id, desc_size)
+        snapshots.append({'id': product_id, 'product_id': product_id, 'content_hash': repositories.snapshot_hash(product),
+                          'title': product['title'], 'description': product['description'], 'price': product['price']})
+
+    db.session.execute(insert(ProductSnapshot), snapshots)
+
+    lines = []
+    for user_id in range(1, users + 1):
+        for product_id in range(1, items + 1):
+            lines.append({'user_id': user_id, 'product_id': product_id, 'snapshot_id': product_id,
+                          'quantity': 1 + (user_id + product_id) % 5, 'auto_date': now})
+
+            if len(lines) >= 10000:
+                db.session.execute(insert(ShoppingCart), lines)
+                lines = []
+
+    if lines:
+        db.session.execute(insert(ShoppingCart), lines)
+
+    db.session.execute(insert(CartVersion), [{'user_id': user_id, 'version': 1} for user_id in range(1, users + 1)])
+    # Totals are kept up to date by the writes, the seeded lines need theirs computed once
+    add_cart_totals(db.session.connection())
+    db.session.commit()
+
+    return {'db': os.path.abspath(db_path), 'users': users, 'items_per_cart': items, 'lines': users * items,
+            'size_bytes': os.path.getsize(db_path)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Seed a shopping cart database for benchmarks")
+    parser.add_argument('--db', default='bench.sqlite3')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--items', type=int, default=10, help="items per cart")
+    parser.add_argument('--desc-size', type=int, default=200, help="length of product descriptions")
+    args = parser.parse_args()
+
+    print(seed(args.db, args.users, args.items, args.desc_size))
@@ -0,0 +1,117 @@
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#
+# CPU time and size of a cart response per serialization path
+#
+#   python -m bench.serialization --items 20 100 500 --desc-size 1000
+#
+# marshal + json is how responses were built with flask_restful's `marshal` and the stdlib
+# encoder, compiled + json/msgpack is the path of `serialization.py`. Sizes are given raw and
+# compressed the way `compress_response` does it.
+#
+
+
+def make_lines(items: int, desc_size: int) -> list:
+    from bench.stub_catalog import make_product
+
+    now   = datetime.datetime.now()
+    lines = []
+    for product_id in range(1, items + 1):
+        product = make_product(product_id, desc_size)
+        lines.append({'id': product_id, 'user_id': 1, 'username': 'user1', 'product_id': product_id,
+                      'product_title': product['title'], 'product_desc': product['description'],
+                      'product_price': product['price'], 'quantity': 1 + product_id % 5, 'auto_date': now})
+    return lines
+
+
+def best_time(function, repeat: int) -> float:
+    """
+     Best of 5 runs of `repeat` calls, in microseconds per call
+    """
+    best = float('inf')
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        best = min(best, (time.perf_counter() - started) / repeat)
+    return round(best * 1e6, 1)
+
+
+def measure(items: int, desc_size: int, repeat: int) -> dict:
+    from flask_restful import marshal
+
+    import serialization
+    from serialization import compile_fields, dumps_json
+    from shopping_cart import shopping_cart_fields
+
+    lines     = make_lines(items, desc_size)
+    serialize = compile_fields(shopping_cart_fields)
+
+    paths = {
+        'marshal+json': lambda: json.dumps(marshal(lines, shopping_cart_fields)).encode(),
+        'compiled+json': lambda: dumps_json([serialize(line) for line in lines]),
+    }
+    if serialization.msgpack is not None:
+        paths['compiled+msgpack'] = lambda: serialization.dumps_msgpack([serialize(line) for line in lines])
+
+    result = {}
+    for name, path in paths.items():
+        body  = path()
+        sizes = {'identity': len(body), 'gzip': len(gzip.compress(body, compresslevel=5))}
+        cpu   = {'encode_us': best_time(path, repeat), 'gzip_us': best_time(lambda: gzip.compress(body, compresslevel=5), repeat)}
+
+        if serialization.brotli is not None:
+            sizes['br']  = len(serialization.brotli.compress(body, quality=4))
+            cpu['br_us'] = best_time(lambda: serialization.brotli.compress(body, quality=4), repeat)
+
+        result[name] = {'bytes': sizes, **cpu}
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cart serialization and compression")
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 500], help="cart lines")
+    parser.add_argument('--desc-size', type=int, default=500, help="length of product descriptions")
+    parser.add_argument('--repeat', type=int, default=50, help="calls per timing run")
+    parser.add_argument('--output', default='bench_serialization.json')
+    args = parser.parse_args()
+
+    # The app must not try to reach a real database or catalog, only its models and fields are used
+    os.environ.setdefault('CART_DATABASE_URI', 'sqlite://')
+    sys.path.insert(0, ROOT)
+    import serialization
+
+    results = {}
+    for items in args.items:
+        results[items] = measure(items, args.desc_size, args.repeat)
+        for name, result in results[items].items():
+            sizes = '  '.join(f"{encoding} {size}" for encoding, size in result['bytes'].items())
+            print(f"{items:>5} lines  {name:17} {result['encode_us']:>9} us  {sizes}")
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':    platform.python_version(),
+        'platform':  platform.platform(),
+        'encoders':  {'orjson': serialization.orjson is not None, 'msgpack': serialization.msgpack is not None,
+                      'brotli': serialization.brotli is not None},
+        'config':    {key: value for key, value in vars(args).items() if key != 'output'},
+        'results':   results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import argparse
+import logging
+import os
+import sys
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#
+# Serves the Flask app of `shopping_cart.py` on a threaded server without the
+# debugger and reloader. Configuration comes from the same environment variables.
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the cart API for benchmarks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from shopping_cart import app, migrate_databases, start_background_jobs
+
+    migrate_databases()
+    start_background_jobs()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server(args.host, args.port, app, threaded=True)
+    print(f"Serving on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
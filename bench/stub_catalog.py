@@ -0,0 +1,110 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#
+# Local stand-in for the users/products API (fakestoreapi.com), with configurable latency and errors
+#
+
+
+def make_user(user_id: int) -> dict:
+    return {'id': user_id, 'username': f"user{user_id}", 'email': f"user{user_id}@example.com"}
+
+
+def make_product(product_id: int, desc_size: int = 200) -> dict:
+    description = (f"Product #{product_id} description. " * (desc_size // 20 + 1))[:desc_size]
+    return {'id': product_id, 'title': f"Product #{product_id}", 'description': description,
+            'price': round(product_id * 1.5, 2), 'category': 'bench'}
+
+
+class StubCatalog():
+    def __init__(self, users: int = 100, products: int = 200, desc_size: int = 200,
+                 latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0):
+        """
+         Catalog data and behaviour, ids 1..users and 1..products exist
+        """
+        self.users      = {user_id: make_user(user_id) for user_id in range(1, users + 1)}
+        self.products   = {product_id: make_product(product_id, desc_size) for product_id in range(1, products + 1)}
+        self.latency_ms = latency_ms
+        self.jitter_ms  = jitter_ms
+        self.error_rate = error_rate
+        self.requests   = 0
+        self._lock      = threading.Lock()
+
+
+    def handle(self, path: str):
+        """
+         Returns (status, body) for a GET on `path`
+        """
+        with self._lock:
+            self.requests += 1
+
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, b'Service Unavailable'
+
+        parts = path.split('?')[0].strip('/').split('/')
+        items = {'users': self.users, 'products': self.products}.get(parts[0])
+
+        if items is None or len(parts) > 2:
+            return 404, b''
+        if len(parts) == 1:
+            return 200, json.dumps(list(items.values())).encode()
+
+        # Like fakestoreapi, unknown ids are answered with an empty body
+        item = items.get(int(parts[1])) if parts[1].isdigit() else None
+        return 200, json.dumps(item).encode() if item is not None else b''
+
+
+def start_stub(host: str = '127.0.0.1', port: int = 0, **options):
+    """
+     Serve a StubCatalog in a background thread, returns (server, catalog, base_url)
+    """
+    catalog = StubCatalog(**options)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            status, body = catalog.handle(self.path)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stub-catalog', daemon=True).start()
+
+    return server, catalog, f"http://{host}:{server.server_address[1]}/"
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=100, help="users in the catalog")
+    parser.add_argument('--products', type=int, default=200, help="products in the catalog")
+    parser.add_argument('--desc-size', type=int, default=200, help="length of product descriptions")
+    parser.add_argument('--latency-ms', type=float, default=0, help="added latency per catalog call")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="random +/- jitter on the latency")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of catalog calls answered with a 503")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stub users/products API for benchmarks")
+    parser.add_argument('--port', type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, _, base_url = start_stub(port=args.port, users=args.users, products=args.products, desc_size=args.desc_size,
+                                     latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    print(f"Stub catalog on {base_url}")
+    threading.Event().wait()
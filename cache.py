@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache():
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, negative_ttl: float = 30):
+        """
+         Bounded LRU cache with per-entry expiry
+
+         Values are kept for `ttl` seconds, cached "does not exist" answers
+         (exceptions raised by the loader) for `negative_ttl` seconds.
+        """
+        self._maxsize      = maxsize
+        self._ttl          = ttl
+        self._negative_ttl = negative_ttl
+
+        self._entries      = OrderedDict()  # key -> (expires_at, value, (error type, args))
+        self._inflight     = {}             # key -> threading.Event
+        self._ainflight    = {}             # key -> asyncio.Future
+        self._lock         = threading.Lock()
+
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+
+
+    def get_or_load(self, key, loader, negative=()):
+        """
+         Return the cached value of `key`, calling `loader()` on a miss
+
+         Concurrent misses on the same key wait for a single `loader()` call.
+         Exceptions listed in `negative` are cached and re-raised on hits,
+         anything else is raised to the caller without being cached.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    expires_at, value, error = entry
+                    if expires_at > time.monotonic():
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        if error is not None:
+                            # A new instance every time, re-raising one would grow its traceback on every hit
+                            error_type, args = error
+                            raise error_type(*args)
+                        return value
+                    del self._entries[key]
+
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    waiter = self._inflight[key] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # Somebody else is already loading this key, wait for it and retry
+            waiter.wait()
+
+        try:
+            value = loader()
+        except negative as e:
+            self._store(key, None, e, self._negative_ttl)
+            raise
+        except BaseException:
+            self._release(key)
+            raise
+
+        self._store(key, value, None, self._ttl)
+        return value
+
+
+    async def aget_or_load(self, key, loader, negative=()):
+        """
+         Coroutine version of `get_or_load`, `loader` is an async callable
+
+         Concurrent misses on the same key await a single `loader()` call.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    expires_at, value, error = entry
+                    if expires_at > time.monotonic():
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        if error is not None:
+                            # A new instance every time, re-raising one would grow its traceback on every hit
+                            error_type, args = error
+                            raise error_type(*args)
+                        return value
+                    del self._entries[key]
+
+                waiter = self._ainflight.get(key)
+                if waiter is None:
+                    waiter = self._ainflight[key] = asyncio.get_running_loop().create_future()
+                    self.misses += 1
+                    break
+
+            await asyncio.shield(waiter)
+
+        try:
+            value = await loader()
+        except negative as e:
+            self._store(key, None, e, self._negative_ttl)
+            self._arelease(key)
+            raise
+        except BaseException:
+            self._arelease(key)
+            raise
+
+        self._store(key, value, None, self._ttl)
+        self._arelease(key)
+        return value
+
+
+    def invalidate(self, key=None):
+        """
+         Drop one key, or the whole cache when no key is given
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+    def stats(self) -> dict:
+        """
+         Snapshot of the cache counters
+        """
+        with self._lock:
+            return {
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'evictions': self.evictions,
+                'size':      len(self._entries),
+                'maxsize':   self._maxsize,
+            }
+
+
+    def _store(self, key, value, error, ttl):
+        with self._lock:
+            if ttl > 0:
+                # Errors are kept as their type and arguments, not the instance and its traceback
+                error = (type(error), error.args) if error is not None else None
+                self._entries[key] = (time.monotonic() + ttl, value, error)
+                self._entries.move_to_end(key)
+
+                while len(self._entries) > self._maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+            waiter = self._inflight.pop(key, None)
+
+        if waiter is not None:
+            waiter.set()
+
+
+    def _release(self, key):
+        with self._lock:
+            waiter = self._inflight.pop(key, None)
+
+        if waiter is not None:
+            waiter.set()
+
+
+    def _arelease(self, key):
+        with self._lock:
+            waiter = self._ainflight.pop(key, None)
+
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
@@ -0,0 +1,162 @@
+import datetime
+import threading
+import time
+
+from sqlalchemy import delete, exists, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import aliased
+
+from logger import logger_factory
+from shopping_cart import CartTotals, CartVersion, ShoppingCart
+from repositories import delete_orphan_snapshots_statement
+
+logger = logger_factory(__name__)
+
+#
+# Expiry of abandoned shopping carts
+#
+# A cart is stale when its newest line was added (`auto_date`) longer than the TTL ago. Stale
+# carts are deleted a bounded batch at a time, each batch in its own short transaction with a
+# pause in between, so live requests are never kept waiting on the write lock for long. The
+# freed pages are then given back with incremental vacuum, in bounded steps too.
+#
+
+
+def stale_carts_statement(cutoff: datetime.datetime, limit: int):
+    """
+     Users whose newest cart line was added before `cutoff`, at most `limit` of them
+    """
+    newer = aliased(ShoppingCart)
+    return select(ShoppingCart.user_id).where(
+        ShoppingCart.auto_date < cutoff,
+        ~exists().where(newer.user_id == ShoppingCart.user_id, newer.auto_date >= cutoff),
+    ).distinct().limit(limit)
+
+
+def expire_batch(engine, cutoff: datetime.datetime, batch_size: int) -> set:
+    """
+     Delete up to `batch_size` stale carts in one transaction, returns their users
+
+     Their totals and the product snapshots no other line uses go with them, and their versions are
+     bumped, so cached ETags don't match any more.
+    """
+    with engine.begin() as conn:
+        # The carts are picked by the DELETE itself, under the write lock, so a line added meanwhile keeps its cart
+        lines = conn.execute(delete(ShoppingCart).where(ShoppingCart.user_id.in_(stale_carts_statement(cutoff, batch_size)))
+                             .returning(ShoppingCart.user_id, ShoppingCart.snapshot_id)).all()
+        if not lines:
+            return set()
+
+        user_ids = {line.user_id for line in lines}
+        conn.execute(delete_orphan_snapshots_statement({line.snapshot_id for line in lines}))
+        conn.execute(delete(CartTotals).where(CartTotals.user_id.in_(user_ids)))
+
+        table = CartVersion.__table__
+        conn.execute(insert(table).on_conflict_do_update(index_elements=[table.c.user_id], set_={'version': table.c.version + 1}),
+                     [{'user_id': user_id, 'version': 1} for user_id in user_ids])
+
+    return user_ids
+
+
+def reclaim_space(engine, pages_per_step: int = 1000, pause: float = 0.05) -> int:
+    """
+     Give the free pages of the database back to the file system, `pages_per_step` at a time
+
+     Needs `auto_vacuum = INCREMENTAL`, set by the migrations. Returns the number of pages freed.
+    """
+    # The pragma is stepped to the end by executescript only, so this goes straight to the driver
+    raw = engine.raw_connection()
+    try:
+        connection = raw.driver_connection
+        if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+
+        freed = 0
+        while True:
+            free = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return freed
+
+            # Runs in its own short transaction, every step frees one page
+            connection.executescript(f"PRAGMA incremental_vacuum({min(free, pages_per_step)})")
+            step = free - connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if step <= 0:
+                return freed
+
+            freed += step
+            time.sleep(pause)
+    finally:
+        raw.close()
+
+
+def expire_carts(engine, ttl: datetime.timedelta, batch_size: int = 500, pause: float = 0.05) -> dict:
+    """
+     Delete every cart without a new line for `ttl`, then reclaim their space
+    """
+    cutoff = datetime.datetime.now() - ttl
+    report = {'carts': 0, 'batches': 0}
+
+    while True:
+        user_ids = expire_batch(engine, cutoff, batch_size)
+        if not user_ids:
+            break
+
+        report['carts']   += len(user_ids)
+        report['batches'] += 1
+
+        if len(user_ids) < batch_size:
+            break
+        time.sleep(pause)
+
+    report['pages_freed'] = reclaim_space(engine, pause=pause) if report['carts'] else 0
+    return report
+
+
+class CartExpiry(threading.Thread):
+    def __init__(self, engines: list, ttl: datetime.timedelta, interval: float, batch_size: int = 500):
+        """
+         Background thread that expires stale carts in every database (the main one and the shards) every `interval` seconds
+        """
+        super().__init__(name='cart-expiry', daemon=True)
+
+        self._engines    = engines
+        self._ttl        = ttl
+        self._interval   = interval
+        self._batch_size = batch_size
+        self._stopped    = threading.Event()
+
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.expire()
+            self._stopped.wait(self._interval)
+
+
+    def expire(self):
+        """
+         Run one expiry pass, errors are logged and retried on the next round
+        """
+        results = []
+        for engine in self._engines:
+            try:
+                result = expire_carts(engine, self._ttl, self._batch_size)
+                logger.info(f"Expired carts in {engine.url}: {result}")
+                results.append(result)
+            except Exception:
+                logger.exception(f"Cart expiry failed in {engine.url}")
+
+        return results
+
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    from shopping_cart import app, db
+
+    if not app.config['CART_EXPIRY_DAYS']:
+        raise SystemExit("CART_EXPIRY_DAYS isn't set, no cart is stale")
+
+    print(CartExpiry(list(db.engines.values()), datetime.timedelta(days=app.config['CART_EXPIRY_DAYS']), 0,
+                     app.config['CART_EXPIRY_BATCH_SIZE']).expire())
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import threading
+
+from sqlalchemy import delete, insert, select, update
+
+from logger import logger_factory
+import shopping_cart
+from shopping_cart import CatalogProduct, CatalogUser
+
+logger = logger_factory(__name__)
+
+
+def content_hash(item: dict) -> str:
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode()).hexdigest()
+
+
+def sync_model(db_session, client, model, url: str, columns) -> dict:
+    """
+     Bring one mirror table in line with a list endpoint of the external API
+
+     Only new, changed (by content hash) and removed rows are written. `columns` maps the
+     extra table columns to a function of the item. Returns the changed ids and counters.
+    """
+    items    = {item['id']: item for item in client.get(url).json()}
+    existing = dict(db_session.execute(select(model.id, model.content_hash)).all())
+
+    inserts, updates = [], []
+    for item_id, item in items.items():
+        digest = content_hash(item)
+        if existing.get(item_id) == digest:
+            continue
+
+        row = {'id': item_id, 'data': item, 'content_hash': digest, **{column: value(item) for column, value in columns.items()}}
+        (updates if item_id in existing else inserts).append(row)
+
+    removed = [item_id for item_id in existing if item_id not in items]
+
+    if inserts:
+        db_session.execute(insert(model), inserts)
+    if updates:
+        db_session.execute(update(model), updates)
+    if removed:
+        db_session.execute(delete(model).where(model.id.in_(removed)))
+
+    return {
+        'inserted': len(inserts),
+        'updated':  len(updates),
+        'removed':  len(removed),
+        'changed':  [row['id'] for row in inserts + updates] + removed,
+    }
+
+
+def sync_catalog(db_session, client=None, base_url: str = None) -> dict:
+    """
+     Import or refresh the users and products mirror in one transaction
+
+     The first run is a bulk import, later runs only rewrite what changed. The API defaults
+     to the one configured in `shopping_cart`, pass a `base_url` to point it elsewhere.
+    """
+    client   = client or shopping_cart.catalog_client
+    base_url = base_url or shopping_cart.catalog_api_url
+
+    users    = sync_model(db_session, client, CatalogUser, base_url + 'users', {'username': lambda user: user.get('username')})
+    products = sync_model(db_session, client, CatalogProduct, base_url + 'products', {
+        'title': lambda product: product.get('title'),
+        'price': lambda product: product.get('price'),
+    })
+    db_session.commit()
+
+    # Cached remote answers about changed ids are stale now
+    for user_id in users.pop('changed'):
+        shopping_cart.user_cache.invalidate(user_id)
+    for product_id in products.pop('changed'):
+        shopping_cart.product_cache.invalidate(product_id)
+
+    return {'users': users, 'products': products}
+
+
+class CatalogRefresher(threading.Thread):
+    def __init__(self, app, db, interval: float, client=None, base_url: str = None):
+        """
+         Background thread that keeps the catalog mirror fresh every `interval` seconds
+        """
+        super().__init__(name='catalog-refresher', daemon=True)
+
+        self._app      = app
+        self._db       = db
+        self._interval = interval
+        self._client   = client
+        self._base_url = base_url
+        self._stopped  = threading.Event()
+
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self._interval)
+
+
+    def refresh(self):
+        """
+         Run one sync, errors are logged and retried on the next round
+        """
+        with self._app.app_context():
+            try:
+                result = sync_catalog(self._db.session, self._client, self._base_url)
+                logger.info(f"Catalog mirror synced: {result}")
+                return result
+            except Exception:
+                self._db.session.rollback()
+                logger.exception("Catalog mirror sync failed")
+            finally:
+                self._db.session.remove()
+
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    from shopping_cart import db
+
+    print(sync_catalog(db.session))
@@ -1,24 +1,172 @@
+import atexit
+import contextvars
+import datetime
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+import uuid
 
-def logger_factory(name):
-    logger = logging.getLogger(name)
+#
+# Logging pipeline
+#
+# Loggers only put records on a bounded queue, a background listener formats them and does the
+# stream/file I/O. It's set up once per process, whatever the number of `logger_factory` calls.
+# Records carry the id of the request that logged them, repeated errors from the same line are
+# rate-limited.
+#
+
+LOG_FILE       = os.environ.get('CART_LOG_FILE', 'info.log')
+LOG_FORMAT     = os.environ.get('CART_LOG_FORMAT', 'json')                 # 'json' or 'text' for the file
+LOG_QUEUE_SIZE = int(os.environ.get('CART_LOG_QUEUE_SIZE', 10000))          # records waiting for the listener, extra ones are dropped
+LOG_RATE_LIMIT = int(os.environ.get('CART_LOG_RATE_LIMIT', 10))            # errors per logging line and minute, 0 disables the limit
 
-    sys_log_handler = logging.StreamHandler()
-    info_handler    = logging.StreamHandler()
-    to_file_handler = logging.FileHandler(filename='info.log')
+TEXT_FORMAT    = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+HANDLER_NAME   = 'cart-log-queue'
 
-    sys_log_handler.setLevel(logging.ERROR)
-    info_handler.setLevel(logging.INFO)
-    to_file_handler.setLevel(logging.INFO)
+_request_id    = contextvars.ContextVar('request_id', default=None)
+_lock          = threading.Lock()
+_queue_handler = None
+_listener      = None
 
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    sys_log_handler.setFormatter(formatter)
-    info_handler.setFormatter(formatter)
-    to_file_handler.setFormatter(formatter)
 
-    logger.addHandler(sys_log_handler)
-    logger.addHandler(info_handler)
-    logger.addHandler(to_file_handler)
+def logger_factory(name):
+    """
+     Logger `name`, wired to the shared queue once however often it's asked for
+    """
+    logger = logging.getLogger(name)
+
+    if not any(handler.name == HANDLER_NAME for handler in logger.handlers):
+        logger.addHandler(_get_queue_handler())
 
     logger.setLevel(logging.WARNING)
     return logger
+
+
+def set_request_id(request_id: str = None) -> str:
+    """
+     Tag the records logged from now on in this context (request) with `request_id`, a new one by default
+    """
+    request_id = request_id or uuid.uuid4().hex
+    _request_id.set(request_id)
+    return request_id
+
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+     One JSON object per record
+    """
+    def format(self, record) -> str:
+        line = {
+            'time':       datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level':      record.levelname,
+            'logger':     record.name,
+            'message':    record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        if getattr(record, 'suppressed', 0):
+            line['suppressed'] = record.suppressed
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(line, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate: int = 10, per: float = 60, level: int = logging.ERROR):
+        """
+         Let at most `rate` records of `level` and above through per logging line and `per` seconds
+
+         Records are grouped by where they were logged from rather than by text, messages built with
+         f-strings differ by ids. The first record let through after a suppressed run carries the
+         number of records dropped in `suppressed`.
+        """
+        super().__init__()
+        self._rate   = rate
+        self._per    = per
+        self._level  = level
+        self._lock   = threading.Lock()
+        self._counts = {}
+
+
+    def filter(self, record) -> bool:
+        if not self._rate or record.levelno < self._level:
+            return True
+
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+
+        with self._lock:
+            window_start, count, suppressed = self._counts.get(key, (now, 0, 0))
+            if now - window_start >= self._per:
+                window_start, count = now, 0
+
+            if count >= self._rate:
+                self._counts[key] = (window_start, count, suppressed + 1)
+                return False
+
+            self._counts[key] = (window_start, count + 1, 0)
+
+        record.suppressed = suppressed
+        return True
+
+
+class RequestQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        """
+         Enqueue records for the listener, tagged with the current request id
+
+         Formatting (exception tracebacks included) is left to the listener thread, a full queue
+         drops the record instead of blocking the caller.
+        """
+        super().__init__(log_queue)
+        self.name    = HANDLER_NAME
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        record.request_id = _request_id.get()
+        # Freeze the message, its arguments may change once the caller moves on
+        record.msg        = record.getMessage()
+        record.args       = None
+        return record
+
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _get_queue_handler():
+    global _queue_handler, _listener
+
+    with _lock:
+        if _queue_handler is not None:
+            return _queue_handler
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        file_handler = logging.FileHandler(filename=LOG_FILE, delay=True)
+        file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+
+        _queue_handler = RequestQueueHandler(log_queue)
+        _queue_handler.addFilter(RateLimitFilter(rate=LOG_RATE_LIMIT))
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+        _listener.start()
+        # Flush what's still queued on exit
+        atexit.register(_listener.stop)
+
+        return _queue_handler
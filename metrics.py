@@ -0,0 +1,354 @@
+import bisect
+import collections
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import Response, request
+from sqlalchemy import event
+
+from logger import get_request_id, logger_factory
+
+logger = logger_factory(__name__)
+
+#
+# Request instrumentation
+#
+# Every request gets a breakdown of where its time went (catalog calls, database queries,
+# serialization), exported as Prometheus histograms/counters on /metrics. The optional profiler
+# samples the stacks of profiled requests and writes the breakdown of slow ones to a file.
+#
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter():
+    TYPE = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """
+         Monotonic counter with a value per label set
+        """
+        self.name          = name
+        self.documentation = documentation
+        self.labelnames    = tuple(labelnames)
+        self._values       = collections.defaultdict(float)
+        self._lock         = threading.Lock()
+
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+
+        for key, value in values:
+            yield self.name, key, value
+
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Counter):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """
+         Cumulative histogram of observed values per label set, in seconds for durations
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Label set -> [per bucket counts (+Inf last), sum]
+        self._values = {}
+
+
+    def observe(self, value: float, **labels):
+        key   = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1]        += value
+
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', key + (('le', '+Inf' if bound == float('inf') else repr(bound)),), cumulative
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, cumulative
+
+
+class Registry():
+    def __init__(self):
+        """
+         Set of metrics rendered together in the Prometheus text format
+        """
+        self._metrics = []
+
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+
+            for name, key, value in metric.samples():
+                labels = [(label, key[i]) for i, label in enumerate(metric.labelnames)] + list(key[len(metric.labelnames):])
+                labels = ','.join(f'{label}="{_escape(value)}"' for label, value in labels)
+                lines.append(f"{name}{{{labels}}} {_format(value)}" if labels else f"{name} {_format(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests_total = registry.register(Counter(
+    'cart_http_requests_total', "HTTP requests by route, method and status code", ('route', 'method', 'status')))
+http_request_duration_seconds = registry.register(Histogram(
+    'cart_http_request_duration_seconds', "HTTP request latency by route, method and status code", ('route', 'method', 'status')))
+stage_duration_seconds = registry.register(Histogram(
+    'cart_stage_duration_seconds', "Time spent in catalog calls, database queries and serialization", ('stage',)))
+catalog_cache = registry.register(Gauge(
+    'cart_catalog_cache', "Catalog cache counters (hits, misses, evictions, size)", ('cache', 'stat')))
+group_commit = registry.register(Gauge(
+    'cart_group_commit', "Group commit counters (groups, operations)", ('stat',)))
+
+
+class RequestBreakdown():
+    def __init__(self, method: str, path: str, route: str):
+        """
+         Time spent per stage by one request, catalog calls made from worker threads included
+        """
+        self.method  = method
+        self.path    = path
+        self.route   = route
+        self.status  = 500
+        self.started = time.perf_counter()
+        self.stages  = {}
+        self.samples = None
+        self._lock   = threading.Lock()
+
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            count, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds)
+
+
+    def to_dict(self, duration: float) -> dict:
+        with self._lock:
+            stages = {stage: {'count': count, 'ms': round(total * 1000, 3)} for stage, (count, total) in self.stages.items()}
+
+        return {
+            'time':        datetime.datetime.now().isoformat(timespec='milliseconds'),
+            'request_id':  get_request_id(),
+            'method':      self.method,
+            'path':        self.path,
+            'route':       self.route,
+            'status':      self.status,
+            'duration_ms': round(duration * 1000, 3),
+            'stages':      stages,
+            'samples':     dict(self.samples.most_common()) if self.samples is not None else None,
+        }
+
+
+_current_request = contextvars.ContextVar('cart_request', default=None)
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """
+     Time a block (or a function, as a decorator) as `stage` of the current request
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(stage, time.perf_counter() - started)
+
+
+def _record(stage: str, seconds: float):
+    stage_duration_seconds.observe(seconds, stage=stage)
+
+    breakdown = _current_request.get()
+    if breakdown is not None:
+        breakdown.add(stage, seconds)
+
+
+class SamplingProfiler():
+    def __init__(self, path: str, slow_ms: float, sample_rate: float = 1.0, interval: float = 0.005, max_depth: int = 30):
+        """
+         Sample the stacks of profiled requests every `interval` seconds
+
+         A `sample_rate` share of the requests is profiled. Those slower than `slow_ms` are appended
+         to `path` as one JSON line with their stage breakdown and the sampled stacks, collapsed into
+         "outer;...;inner" strings with a count each.
+        """
+        self.path        = path
+        self.slow_ms     = slow_ms
+        self.sample_rate = sample_rate
+        self._interval   = interval
+        self._max_depth  = max_depth
+        self._threads    = {}
+        self._lock       = threading.Lock()
+        self._file_lock  = threading.Lock()
+
+        self._worker     = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._worker.start()
+
+
+    def start(self, breakdown: RequestBreakdown) -> bool:
+        if random.random() >= self.sample_rate:
+            return False
+
+        breakdown.samples = collections.Counter()
+        with self._lock:
+            self._threads[threading.get_ident()] = breakdown
+        return True
+
+
+    def stop(self, breakdown: RequestBreakdown, duration: float):
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+
+        if duration * 1000 < self.slow_ms:
+            return
+
+        try:
+            line = json.dumps(breakdown.to_dict(duration))
+            with self._file_lock, open(self.path, 'a') as f:
+                f.write(line + '\n')
+        except OSError:
+            logger.exception(f"Couldn't write the profile of a slow request to {self.path}")
+
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+
+            # Under the lock, a request that stopped is never sampled while its report is written
+            with self._lock:
+                if not self._threads:
+                    continue
+
+                frames = sys._current_frames()
+                for thread_id, breakdown in self._threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        breakdown.samples[self._collapse(frame)] += 1
+
+
+    def _collapse(self, frame) -> str:
+        stack = []
+        while frame is not None and len(stack) < self._max_depth:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+
+        return ';'.join(reversed(stack))
+
+
+def instrument_engine(engine):
+    """
+     Record the time of every query on `engine` as the `db` stage
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _record('db', time.perf_counter() - conn.info['query_started'].pop())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+def instrument(app, engine, profiler: SamplingProfiler = None):
+    """
+     Record every request of `app` and every query on `engine`
+
+     The request is labelled with its route rule (e.g. /cart/user/<int:user_id>) rather than its
+     path, so the number of series stays bounded.
+    """
+    instrument_engine(engine)
+
+    @app.before_request
+    def start_request():
+        route     = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        breakdown = RequestBreakdown(request.method, request.path, route)
+        _current_request.set(breakdown)
+
+        if profiler is not None:
+            profiler.start(breakdown)
+
+    @app.after_request
+    def record_status(response):
+        breakdown = _current_request.get()
+        if breakdown is not None:
+            breakdown.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request(error=None):
+        breakdown = _current_request.get()
+        if breakdown is None:
+            return
+        _current_request.set(None)
+
+        duration = time.perf_counter() - breakdown.started
+        labels   = {'route': breakdown.route, 'method': breakdown.method, 'status': breakdown.status}
+        http_requests_total.inc(**labels)
+        http_request_duration_seconds.observe(duration, **labels)
+
+        if profiler is not None and breakdown.samples is not None:
+            profiler.stop(breakdown, duration)
+
+
+def metrics_response() -> Response:
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
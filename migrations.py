@@ -0,0 +1,224 @@
+import hashlib
+import json
+
+from sqlalchemy import inspect, text
+
+from logger import logger_factory
+from storage import WRITE_TRANSACTION
+
+logger = logger_factory(__name__)
+
+#
+# Schema migrations for existing shopping_cart_db.sqlite3 files
+#
+# The schema version is kept in SQLite's `PRAGMA user_version`. New databases are created with
+# the latest schema straight from the models, existing ones run every step above their version.
+#
+
+
+class MigrationFailedException(Exception):
+    """
+     Raised when a step would lose data, the whole migration is rolled back
+    """
+    pass
+
+
+def add_cart_indexes(conn):
+    """
+     Remove duplicated cart lines and add the (user_id, product_id) unique index
+    """
+    duplicates = conn.execute(text(
+        "DELETE FROM shopping_cart WHERE id NOT IN "
+        "(SELECT MIN(id) FROM shopping_cart GROUP BY user_id, product_id)"
+    )).rowcount
+    if duplicates:
+        logger.warning(f"Removed {duplicates} duplicated shopping cart lines")
+
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_shopping_cart_user_product ON shopping_cart (user_id, product_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_shopping_cart_product_id ON shopping_cart (product_id)"))
+
+
+def add_cart_versions(conn):
+    """
+     Per-user cart version counter, existing carts start at version 0
+    """
+    conn.execute(text("CREATE TABLE IF NOT EXISTS cart_versions (user_id INTEGER NOT NULL, version INTEGER NOT NULL, PRIMARY KEY (user_id))"))
+
+
+def add_keyset_index(conn):
+    """
+     Index for paginating a user's cart by id
+    """
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_shopping_cart_user_id_id ON shopping_cart (user_id, id)"))
+
+
+def snapshot_hash(title, description, price) -> str:
+    """
+     Must match `repositories.snapshot_hash`
+    """
+    price = float(price) if price is not None else None
+    return hashlib.sha1(json.dumps([title, description, price]).encode()).hexdigest()
+
+
+def normalize_product_snapshots(conn):
+    """
+     Move the product details copied into every cart line into deduplicated product snapshots
+    """
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS product_snapshots (id INTEGER NOT NULL, product_id INTEGER NOT NULL, "
+        "content_hash VARCHAR NOT NULL, title VARCHAR, description VARCHAR, price FLOAT, PRIMARY KEY (id))"
+    ))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_product_snapshots_product_hash ON product_snapshots (product_id, content_hash)"))
+
+    source_lines = conn.execute(text("SELECT COUNT(*) FROM shopping_cart")).scalar()
+    bytes_before = conn.execute(text(
+        "SELECT COALESCE(SUM(IFNULL(LENGTH(username), 0) + IFNULL(LENGTH(product_title), 0) + IFNULL(LENGTH(product_desc), 0)), 0) "
+        "FROM shopping_cart"
+    )).scalar()
+
+    products = conn.execute(text("SELECT DISTINCT product_id, product_title, product_desc, product_price FROM shopping_cart")).all()
+    for product_id, title, description, price in products:
+        conn.execute(text(
+            "INSERT INTO product_snapshots (product_id, content_hash, title, description, price) "
+            "VALUES (:product_id, :content_hash, :title, :description, :price) ON CONFLICT DO NOTHING"
+        ), {'product_id': product_id, 'content_hash': snapshot_hash(title, description, price),
+            'title': title, 'description': description, 'price': price})
+
+    conn.execute(text(
+        "CREATE TABLE shopping_cart_new (id INTEGER NOT NULL, user_id INTEGER, product_id INTEGER, "
+        "snapshot_id INTEGER NOT NULL, quantity INTEGER, auto_date DATETIME, PRIMARY KEY (id), "
+        "FOREIGN KEY(snapshot_id) REFERENCES product_snapshots (id))"
+    ))
+    lines = conn.execute(text(
+        "INSERT INTO shopping_cart_new (id, user_id, product_id, snapshot_id, quantity, auto_date) "
+        "SELECT c.id, c.user_id, c.product_id, s.id, c.quantity, c.auto_date FROM shopping_cart c "
+        "JOIN product_snapshots s ON s.product_id = c.product_id AND s.title IS c.product_title "
+        "AND s.description IS c.product_desc AND s.price IS c.product_price"
+    )).rowcount
+
+    # A line without a matching snapshot wasn't copied, the old table has to stay
+    if lines != source_lines:
+        raise MigrationFailedException(f"Only {lines} of the {source_lines} shopping cart lines matched a product snapshot")
+
+    conn.execute(text("DROP TABLE shopping_cart"))
+    conn.execute(text("ALTER TABLE shopping_cart_new RENAME TO shopping_cart"))
+    conn.execute(text("CREATE UNIQUE INDEX ix_shopping_cart_user_product ON shopping_cart (user_id, product_id)"))
+    conn.execute(text("CREATE INDEX ix_shopping_cart_product_id ON shopping_cart (product_id)"))
+    conn.execute(text("CREATE INDEX ix_shopping_cart_user_id_id ON shopping_cart (user_id, id)"))
+
+    bytes_after = conn.execute(text(
+        "SELECT COALESCE(SUM(IFNULL(LENGTH(title), 0) + IFNULL(LENGTH(description), 0)), 0) FROM product_snapshots"
+    )).scalar()
+    logger.warning(f"Normalized {lines} cart lines into {len(products)} product snapshots, "
+                   f"product text went from {bytes_before} to {bytes_after} bytes")
+
+
+def add_cart_totals(conn):
+    """
+     Per-user cart totals, filled from the existing carts
+    """
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS cart_totals (user_id INTEGER NOT NULL, item_count INTEGER NOT NULL, "
+        "total_quantity INTEGER NOT NULL, total_cents INTEGER NOT NULL, PRIMARY KEY (user_id))"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_cart_totals_total_cents ON cart_totals (total_cents)"))
+
+    # Same cents rounding as `repositories.price_cents`
+    carts = conn.execute(text(
+        "INSERT OR REPLACE INTO cart_totals (user_id, item_count, total_quantity, total_cents) "
+        "SELECT c.user_id, COUNT(*), SUM(c.quantity), SUM(c.quantity * COALESCE(CAST(ROUND(s.price * 100) AS INTEGER), 0)) "
+        "FROM shopping_cart c JOIN product_snapshots s ON s.id = c.snapshot_id GROUP BY c.user_id"
+    )).rowcount
+    logger.warning(f"Computed the totals of {carts} shopping carts")
+
+
+def add_expiry_index(conn):
+    """
+     Index for finding stale carts by date, and incremental vacuum so the space of expired carts can be given back
+    """
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_shopping_cart_auto_date ON shopping_cart (auto_date)"))
+
+    # Only takes effect with the VACUUM that follows the migration
+    conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+
+
+def add_snapshot_index(conn):
+    """
+     Index for finding the product snapshots no cart line uses any more, and removal of the existing ones
+    """
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_shopping_cart_snapshot_id ON shopping_cart (snapshot_id)"))
+
+    orphans = conn.execute(text("DELETE FROM product_snapshots WHERE id NOT IN (SELECT snapshot_id FROM shopping_cart)")).rowcount
+    if orphans:
+        logger.warning(f"Removed {orphans} unused product snapshots")
+
+
+MIGRATIONS = [
+    (1, add_cart_indexes),
+    (2, add_cart_versions),
+    (3, add_keyset_index),
+    (4, normalize_product_snapshots),
+    (5, add_cart_totals),
+    (6, add_expiry_index),
+    (7, add_snapshot_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(engine, metadata) -> dict:
+    """
+     Bring the database up to the latest schema, safe to call on every start
+
+     When steps were applied the file is vacuumed and its size before/after is reported.
+    """
+    # Every step runs in the one transaction, DDL included, so a failing step leaves the database as it was
+    with engine.execution_options(**WRITE_TRANSACTION).begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        report  = {'from_version': version, 'to_version': version, 'size_before': database_size(conn)}
+
+        if not inspect(conn).has_table('shopping_cart'):
+            # Has to be set before the first table is created
+            conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            metadata.create_all(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {LATEST_VERSION}")
+            report['to_version'] = LATEST_VERSION
+            return report
+
+        for step_version, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+
+            logger.warning(f"Migrating the database to version #{step_version} ({step.__name__})")
+            step(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {step_version}")
+            report['to_version'] = step_version
+
+        # Tables added along the way
+        metadata.create_all(conn)
+
+    if report['to_version'] != version:
+        # VACUUM can't run inside a transaction, go straight to the driver
+        raw = engine.raw_connection()
+        try:
+            raw.driver_connection.execute("VACUUM")
+        finally:
+            raw.close()
+
+        with engine.connect() as conn:
+            report['size_after'] = database_size(conn)
+
+        logger.warning(f"Database migrated from version #{version} to #{report['to_version']}, "
+                       f"size went from {report['size_before']} to {report['size_after']} bytes")
+
+    return report
+
+
+def database_size(conn) -> int:
+    return conn.exec_driver_sql("PRAGMA page_count").scalar() * conn.exec_driver_sql("PRAGMA page_size").scalar()
+
+
+if __name__ == '__main__':
+    from shopping_cart import migrate_databases
+
+    print(migrate_databases())
@@ -1,8 +1,19 @@
-from flask_restful import marshal_with
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+
+from sqlalchemy import Integer, cast, delete, desc, exists, func, literal, select, update
+from sqlalchemy.dialects.sqlite import insert
 from logger import logger_factory
+from metrics import timed
+from serialization import compile_fields
+from storage import begin_write
+from upstream import UpstreamUnavailableException
 
-from shopping_cart import (ModelNotFoundException, ShoppingCart, get_single_product,
-                           get_single_user, shopping_cart_fields)
+from shopping_cart import (CartTotals, CartVersion, ModelNotFoundException, ProductSnapshot, ShoppingCart, cart_summary_fields,
+                           get_products, get_single_product, get_single_user, get_user_and_product, shopping_cart_fields)
 
 #
 # Exceptions
@@ -26,6 +37,18 @@ class InvalidQuantityException(Exception):
     """
     pass
 
+class InvalidBatchOperationException(Exception):
+    """
+     A batch operation is malformed or unknown
+    """
+    pass
+
+class InvalidCartQueryException(Exception):
+    """
+     The pagination cursor, page size or requested fields are invalid
+    """
+    pass
+
 
 logger = logger_factory(__name__)
 
@@ -38,7 +61,7 @@ class ShoppingCartRepository():
 
         # Make sure the user exists before continuing
         try:
-            get_single_user(user_id)
+            user = get_single_user(user_id, db_session)
         except ModelNotFoundException:
             raise ModelNotFoundException(f"User #{user_id} does not exist!", 404)
 
@@ -50,24 +73,77 @@ class ShoppingCartRepository():
         self._session       = db_session
         self._shopping_cart = self._session.query(ShoppingCart).filter_by(user_id=user_id)
         self._user_id       = user_id
+        self._user          = user
 
 
 
-    @marshal_with(shopping_cart_fields)
-    def get(self):
+    def get(self, fields: list = None):
         """
-         Show user's shopping cart
+         Show user's shopping cart, only the requested `fields` of its lines when given
+
+         @throws InvalidCartQuery
         """
-        return self._session.query(ShoppingCart).filter_by(user_id=self._user_id).all()
+        query, serialize = cart_lines_statement(self._user_id, self._user['username'], fields)
+        rows             = self._session.execute(query).all()
 
+        with timed('serialize'):
+            return [serialize(row) for row in rows]
 
-    def delete(self):
+
+    def page(self, after: int = None, limit: int = 50, fields: list = None):
+        """
+         Show one page of user's shopping cart, ordered by id
+
+         Only the requested `fields` are selected. Returns the lines and the cursor of the next page,
+         None when this is the last one.
+
+         @throws InvalidCartQuery
+        """
+        validate_limit(limit)
+
+        query, serialize = cart_lines_statement(self._user_id, self._user['username'], fields)
+        if after is not None:
+            query = query.where(ShoppingCart.id > after)
+
+        # One extra row tells whether there's a next page
+        rows        = self._session.execute(query.limit(limit + 1)).all()
+        next_cursor = rows[limit - 1].id if len(rows) > limit else None
+
+        with timed('serialize'):
+            return [serialize(row) for row in rows[:limit]], next_cursor
+
+
+    def stream(self, fields: list = None, batch_size: int = 100):
+        """
+         Yield user's shopping cart line by line, fetching `batch_size` rows at a time from the database
+
+         @throws InvalidCartQuery
+        """
+        query, serialize = cart_lines_statement(self._user_id, self._user['username'], fields)
+        result           = self._session.execute(query.execution_options(yield_per=batch_size))
+
+        for row in result:
+            yield serialize(row)
+
+
+    def summary(self):
         """
-         Delete user's shopping cart
+         Item count, total quantity and total value of user's shopping cart, read from its totals row
         """
-        product_to_delete = self._session.query(ShoppingCart).filter_by(user_id=self._user_id).first()
+        totals = self._session.execute(cart_summary_statement(self._user_id)).first()
+
+        with timed('serialize'):
+            return serialize_cart_summary(cart_summary(self._user_id, totals))
+
 
-        self._session.delete(product_to_delete)
+    def delete(self):
+        """
+         Delete user's shopping cart, every line of it in one statement
+        """
+        snapshot_ids = set(self._session.execute(delete_cart_statement(self._user_id)).scalars())
+        self._session.execute(delete_orphan_snapshots_statement(snapshot_ids))
+        self._session.execute(delete_cart_totals_statement(self._user_id))
+        self._session.execute(bump_cart_version_statement(self._user_id))
         self._session.commit()
         return 204
 
@@ -78,24 +154,20 @@ class ShoppingCartRepository():
 
 
 class ProductRepository():
-    def __init__(self, db_session, user_id: int, product_id: int):
+    def __init__(self, db_session, user_id: int, product_id: int, user: dict = None, product: dict = None,
+                 autocommit: bool = True):
         """
          Validate the required arguments and initialize the required properties
 
+         An already fetched `user`/`product` can be passed in to skip the external API.
+         With `autocommit=False` the changes are left for the caller to commit.
+
          @throws ModelNotFound
         """
 
-        # Make sure the user exists before continuing
-        try:
-            user = get_single_user(user_id)
-        except ModelNotFoundException:
-            raise ModelNotFoundException(f"User #{user_id} does not exist!")
-
-        # Make sure the product exists before continuing
-        try:
-            product = get_single_product(product_id)
-        except ModelNotFoundException:
-            raise ModelNotFoundException(f"Product #{product_id} does not exist!")
+        # Make sure both the user and the product exist before continuing, they're fetched at the same time
+        if user is None or product is None:
+            user, product = get_user_and_product(user_id, product_id, db_session)
 
         # Make the shopping cart
         self._session       = db_session
@@ -105,33 +177,31 @@ class ProductRepository():
         self._product_id    = product_id
         self._product       = product
         self._user          = user
+        self._autocommit    = autocommit
 
 
 
-    @marshal_with(shopping_cart_fields)
     def add(self):
         """
          Add the product to the user's shopping cart
 
          @throws ProductAlreadyInShoppingCart
         """
-        if self._session.query(ShoppingCart).filter_by(product_id=self._product_id, user_id=self._user_id).first() != None:
+        snapshot_id = self._session.execute(add_snapshot_statement(self._product_id, self._product)).scalar() \
+            or self._session.execute(find_snapshot_statement(self._product_id, self._product)).scalar()
+
+        # Single statement, the (user_id, product_id) unique index rejects duplicates even under concurrency
+        new_product = self._session.execute(add_product_statement(self._user_id, self._product_id, snapshot_id)).first()
+
+        if new_product == None:
             raise ProductAlreadyInShoppingCartException(f"Product #{self._product_id} is already in user #{self._user_id}'s shopping cart!")
 
-        new_product = ShoppingCart(
-            user_id       = self._user_id,
-            username      = self._user['username'],
-            product_id    = self._product_id,
-            product_title = self._product['title'],
-            product_desc  = self._product['description'],
-            product_price = self._product['price'],
-            quantity      = 1
-        )        
-
-        self._session.add(new_product)
-        self._session.commit()
+        self._session.execute(cart_totals_delta_statement(self._user_id, self._product_id, 1, ShoppingCart.quantity))
+        self._session.execute(bump_cart_version_statement(self._user_id))
+        self._commit()
 
-        return new_product
+        with timed('serialize'):
+            return cart_line_serializer()(cart_line(new_product, self._user, self._product))
 
 
     def delete(self):
@@ -140,17 +210,16 @@ class ProductRepository():
 
          @throws UserDoesNotHaveAShoppingCart
         """
-        # Make sure the user got at least 1 shopping cart instance
-        if self._session.query(ShoppingCart).filter_by(user_id=self._user_id).first() == None:
-            raise UserDoesNotHaveAShoppingCartException(f"User #{self._user_id} does not have any shopping cart instances!")
+        # The line's share of the totals is taken out first, it's read from the line itself
+        self._session.execute(cart_totals_delta_statement(self._user_id, self._product_id, -1, -ShoppingCart.quantity))
+        snapshot_id = self._session.execute(delete_product_statement(self._user_id, self._product_id)).scalar()
 
-        product_to_delete = self._session.query(ShoppingCart).filter_by(user_id=self._user_id, product_id=self._product_id).first()
+        if snapshot_id is None:
+            self._raise_missing_product()
 
-        if product_to_delete == None:
-            raise ModelNotFoundException(f"Product #{self._product_id} does not exist in user #{self._user_id}'s shopping cart!")
-
-        self._session.delete(product_to_delete)
-        self._session.commit()
+        self._session.execute(delete_orphan_snapshots_statement({snapshot_id}))
+        self._session.execute(bump_cart_version_statement(self._user_id))
+        self._commit()
 
         return 204
 
@@ -161,26 +230,448 @@ class ProductRepository():
 
          @throws UserDoesNotHaveAShoppingCart
         """
+        # Validate quantity
+        try:
+            validate_quantity(quantity)
+        except InvalidQuantityException:
+            # Not having a shopping cart at all is reported first
+            if not self._has_shopping_cart():
+                raise UserDoesNotHaveAShoppingCartException(f"User #{self._user_id} does not have any shopping cart instances!")
+            raise
+
+        self._session.execute(cart_totals_delta_statement(self._user_id, self._product_id, 0, quantity - ShoppingCart.quantity))
+        result = self._session.execute(change_quantity_statement(self._user_id, self._product_id, quantity))
+
+        if result.rowcount == 0:
+            self._raise_missing_product()
+
+        self._session.execute(bump_cart_version_statement(self._user_id))
+        self._commit()
+
+        return 200
+
+
+    def _commit(self):
+        if self._autocommit:
+            self._session.commit()
+
+
+    def _has_shopping_cart(self) -> bool:
+        return self._session.execute(has_shopping_cart_statement(self._user_id)).scalar()
+
+
+    def _raise_missing_product(self):
+        """
+         Nothing matched the user/product pair, find out which one is missing
+
+         @throws UserDoesNotHaveAShoppingCart
+         @throws ModelNotFound
+        """
         # Make sure the user got at least 1 shopping cart instance
-        if self._session.query(ShoppingCart).filter_by(user_id=self._user_id).first() == None:
+        if not self._has_shopping_cart():
             raise UserDoesNotHaveAShoppingCartException(f"User #{self._user_id} does not have any shopping cart instances!")
 
-        # Validate quantity
-        if quantity < 1:
-            raise InvalidQuantityException("Quantity must be greater than 0!")
-        elif not isinstance(quantity, int):
-            raise InvalidQuantityException("Quantity must be an integer!")
-        elif quantity > 100:
-            raise InvalidQuantityException("Quantity must be less than 100!")
+        raise ModelNotFoundException(f"Product #{self._product_id} does not exist in user #{self._user_id}'s shopping cart!")
+
+
+
+class CartBatchRepository():
+    # Batch operation -> ProductRepository method
+    OPERATIONS = {
+        'add':          'add',
+        'remove':       'delete',
+        'set_quantity': 'change_quantity',
+    }
+
+    def __init__(self, db_session, user_id: int):
+        """
+         Validate the user once for the whole batch
+
+         @throws ModelNotFound
+        """
+        self._session = db_session
+        self._user_id = user_id
+        self._user    = get_single_user(user_id, db_session)
 
-        
-        product_to_update = self._session.query(ShoppingCart).filter_by(user_id=self._user_id, product_id=self._product_id).first()
 
-        if product_to_update == None:
-            raise ModelNotFoundException(f"Product #{self._product_id} does not exist in user #{self._user_id}'s shopping cart!")
+    def apply(self, operations: list) -> list:
+        """
+         Apply add/remove/set_quantity operations in a single transaction
+
+         Every operation follows the same rules as the single item routes and runs in its own savepoint,
+         so a failing operation doesn't undo the others. Returns one (operation, exception or None) pair
+         per operation, in order.
 
+         @throws InvalidBatchOperation
+        """
+        if not isinstance(operations, list):
+            raise InvalidBatchOperationException("Operations must be a list!")
+        elif len(operations) > MAX_BATCH_SIZE:
+            raise InvalidBatchOperationException(f"A batch can have at most {MAX_BATCH_SIZE} operations!")
+
+        # All referenced products are fetched at the same time, once each
+        product_ids = {operation['product_id'] for operation in operations if self._is_well_formed(operation)}
+        products    = get_products(product_ids, self._session)
+
+        # The savepoints of the operations need a transaction that is really open
+        begin_write(self._session, ShoppingCart)
+
+        results = []
+        for operation in operations:
+            try:
+                self._apply_one(operation, products)
+            except (ModelNotFoundException, UpstreamUnavailableException, ProductAlreadyInShoppingCartException,
+                    UserDoesNotHaveAShoppingCartException, InvalidQuantityException,
+                    InvalidBatchOperationException) as e:
+                results.append((operation, e))
+            else:
+                results.append((operation, None))
 
-        product_to_update.quantity = quantity
         self._session.commit()
+        return results
 
-        return 200
+
+    def _apply_one(self, operation, products: dict):
+        if not self._is_well_formed(operation):
+            raise InvalidBatchOperationException(f"Operation must have an 'op' ({', '.join(self.OPERATIONS)}) and an integer 'product_id'!")
+
+        product = products[operation['product_id']]
+        if isinstance(product, Exception):
+            raise product
+
+        repository = ProductRepository(self._session, self._user_id, operation['product_id'],
+                                       user=self._user, product=product, autocommit=False)
+        method     = getattr(repository, self.OPERATIONS[operation['op']])
+
+        with self._session.begin_nested():
+            if operation['op'] == 'set_quantity':
+                method(operation.get('quantity'))
+            else:
+                method()
+
+
+    def _is_well_formed(self, operation) -> bool:
+        return isinstance(operation, dict) and operation.get('op') in self.OPERATIONS \
+            and isinstance(operation.get('product_id'), int) and not isinstance(operation.get('product_id'), bool)
+
+
+class CartAggregateRepository():
+    def __init__(self, db_session, shards=None):
+        """
+         Aggregates across every shopping cart, for the admin views
+
+         With `shards` the queries run on every shard at the same time and their results are merged.
+        """
+        self._session = db_session
+        self._shards  = shards
+
+
+    def top_products(self, limit: int = 10) -> list:
+        """
+         Products in the most carts by total quantity, with the number of carts and their value
+
+         @throws InvalidCartQuery
+        """
+        validate_limit(limit)
+
+        value = func.sum(ShoppingCart.quantity * price_cents(ProductSnapshot.price))
+        query = select(
+            ShoppingCart.product_id,
+            func.max(ProductSnapshot.title).label('product_title'),
+            func.count().label('carts'),
+            func.sum(ShoppingCart.quantity).label('total_quantity'),
+            value.label('total_cents'),
+        ).join(ProductSnapshot, ProductSnapshot.id == ShoppingCart.snapshot_id).group_by(ShoppingCart.product_id)
+
+        if self._shards is None:
+            rows = self._session.execute(query.order_by(desc('total_quantity'), ShoppingCart.product_id).limit(limit)).mappings().all()
+        else:
+            # A product can be in carts of every shard, each one returns all of its groups to be summed up
+            rows = merge_product_groups(self._shards.scatter(lambda session: session.execute(query).mappings().all()))[:limit]
+
+        return [{
+            'product_id':     row['product_id'],
+            'product_title':  row['product_title'],
+            'carts':          row['carts'],
+            'total_quantity': row['total_quantity'],
+            'total_value':    row['total_cents'] / 100,
+        } for row in rows]
+
+
+    def carts_by_value(self, limit: int = 10) -> list:
+        """
+         Most valuable shopping carts, straight from the totals rows
+
+         @throws InvalidCartQuery
+        """
+        validate_limit(limit)
+
+        query = select(CartTotals).where(CartTotals.item_count > 0) \
+            .order_by(CartTotals.total_cents.desc(), CartTotals.user_id).limit(limit)
+
+        def carts(session):
+            return [cart_summary(totals.user_id, totals) for totals in session.scalars(query)]
+
+        if self._shards is None:
+            return carts(self._session)
+
+        # Users are in a single shard, the top carts are among the top `limit` of every shard
+        merged = heapq.merge(*self._shards.scatter(carts), key=lambda cart: (-cart['total_value'], cart['user_id']))
+        return list(itertools.islice(merged, limit))
+
+
+
+#
+# Statements shared with the async repositories
+#
+
+def validate_quantity(quantity: int):
+    """
+     @throws InvalidQuantity
+    """
+    if not isinstance(quantity, int):
+        raise InvalidQuantityException("Quantity must be an integer!")
+    elif quantity < 1:
+        raise InvalidQuantityException("Quantity must be greater than 0!")
+    elif quantity > 100:
+        raise InvalidQuantityException("Quantity must be less than 100!")
+
+
+MAX_PAGE_SIZE = 500
+
+MAX_BATCH_SIZE = 100
+
+
+def validate_limit(limit: int):
+    """
+     @throws InvalidCartQuery
+    """
+    if not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidCartQueryException(f"Limit must be between 1 and {MAX_PAGE_SIZE}!")
+
+
+def cart_lines_statement(user_id: int, username: str, fields: list = None):
+    """
+     SELECT of a user's cart lines ordered by id, in the `shopping_cart_fields` shape
+
+     Only the requested `fields` are selected and the product snapshots are only joined when needed.
+     The id is always selected since it's the pagination cursor. Returns the statement and the
+     serializer of its rows.
+
+     @throws InvalidCartQuery
+    """
+    if not fields:
+        fields = list(shopping_cart_fields)
+
+    unknown = [field for field in fields if field not in shopping_cart_fields]
+    if unknown:
+        raise InvalidCartQueryException(f"Unknown fields: {', '.join(unknown)}!")
+
+    sources = {
+        'id':            ShoppingCart.id,
+        'user_id':       ShoppingCart.user_id,
+        'username':      literal(username),
+        'product_id':    ShoppingCart.product_id,
+        'product_title': ProductSnapshot.title,
+        'product_desc':  ProductSnapshot.description,
+        'product_price': ProductSnapshot.price,
+        'quantity':      ShoppingCart.quantity,
+        'auto_date':     ShoppingCart.auto_date,
+    }
+    columns = [ShoppingCart.id] + [sources[field].label(field) for field in fields if field != 'id']
+
+    query = select(*columns).select_from(ShoppingCart)
+    if any(field in ('product_title', 'product_desc', 'product_price') for field in fields):
+        query = query.join(ProductSnapshot, ProductSnapshot.id == ShoppingCart.snapshot_id)
+
+    query = query.where(ShoppingCart.user_id == user_id).order_by(ShoppingCart.id)
+
+    return query, cart_line_serializer(tuple(fields))
+
+
+@functools.lru_cache(maxsize=128)
+def cart_line_serializer(fields: tuple = None):
+    """
+     Serializer of cart lines in the `shopping_cart_fields` shape, only `fields` of it when given
+    """
+    return compile_fields({field: shopping_cart_fields[field] for field in fields} if fields else shopping_cart_fields)
+
+
+serialize_cart_summary = compile_fields(cart_summary_fields)
+
+
+def cart_line(row, user: dict, product: dict) -> dict:
+    """
+     A freshly inserted cart line in the `shopping_cart_fields` shape
+    """
+    return {
+        **row._mapping,
+        'username':      user['username'],
+        'product_title': product['title'],
+        'product_desc':  product['description'],
+        'product_price': product['price'],
+    }
+
+
+def snapshot_hash(product: dict) -> str:
+    """
+     Identifies the content of a product snapshot, must match `migrations.snapshot_hash`
+    """
+    price = float(product['price']) if product['price'] is not None else None
+    return hashlib.sha1(json.dumps([product['title'], product['description'], price]).encode()).hexdigest()
+
+
+def get_cart_version(db_session, user_id: int) -> int:
+    """
+     Current version of a user's shopping cart, 0 when it was never changed
+    """
+    return db_session.execute(select(CartVersion.version).where(CartVersion.user_id == user_id)).scalar() or 0
+
+
+def bump_cart_version_statement(user_id: int):
+    table = CartVersion.__table__
+    return insert(table).values(user_id=user_id, version=1) \
+        .on_conflict_do_update(index_elements=[table.c.user_id], set_={'version': table.c.version + 1})
+
+
+def price_cents(price):
+    """
+     SQL expression of a price in cents, 0 when it's unknown
+    """
+    return func.coalesce(cast(func.round(price * 100), Integer), 0)
+
+
+def cart_totals_delta_statement(user_id: int, product_id: int, items: int, quantity):
+    """
+     Upsert adding the change of one cart line to the user's totals row
+
+     `items` is the change in the number of lines and `quantity` the change in quantity, an
+     expression of `ShoppingCart.quantity` since it's read from the line itself, as is its price.
+     Nothing is written when the line doesn't exist, so it runs after an insert and before a
+     delete or an update of the line.
+    """
+    table  = CartTotals.__table__
+    source = select(
+        ShoppingCart.user_id,
+        literal(items),
+        quantity,
+        quantity * price_cents(ProductSnapshot.price),
+    ).join(ProductSnapshot, ProductSnapshot.id == ShoppingCart.snapshot_id) \
+        .where(ShoppingCart.user_id == user_id, ShoppingCart.product_id == product_id)
+
+    statement = insert(table).from_select(['user_id', 'item_count', 'total_quantity', 'total_cents'], source)
+    return statement.on_conflict_do_update(index_elements=[table.c.user_id], set_={
+        'item_count':     table.c.item_count + statement.excluded.item_count,
+        'total_quantity': table.c.total_quantity + statement.excluded.total_quantity,
+        'total_cents':    table.c.total_cents + statement.excluded.total_cents,
+    })
+
+
+def delete_cart_totals_statement(user_id: int):
+    return delete(CartTotals.__table__).where(CartTotals.__table__.c.user_id == user_id)
+
+
+def cart_summary_statement(user_id: int):
+    return select(CartTotals.item_count, CartTotals.total_quantity, CartTotals.total_cents).where(CartTotals.user_id == user_id)
+
+
+def cart_summary(user_id: int, totals) -> dict:
+    """
+     A totals row in the `cart_summary_fields` shape
+    """
+    if totals is None:
+        return {'user_id': user_id, 'item_count': 0, 'total_quantity': 0, 'total_value': 0}
+
+    return {
+        'user_id':        user_id,
+        'item_count':     totals.item_count,
+        'total_quantity': totals.total_quantity,
+        'total_value':    totals.total_cents / 100,
+    }
+
+
+def merge_product_groups(shard_rows: list) -> list:
+    """
+     Sum up the per-product groups of several shards, ordered like `top_products`
+    """
+    merged = {}
+    for rows in shard_rows:
+        for row in rows:
+            group = merged.get(row['product_id'])
+            if group is None:
+                merged[row['product_id']] = dict(row)
+                continue
+
+            # MAX() ignores NULLs, so does this
+            titles                   = [title for title in (group['product_title'], row['product_title']) if title is not None]
+            group['product_title']   = max(titles, default=None)
+            group['carts']          += row['carts']
+            group['total_quantity'] += row['total_quantity']
+            group['total_cents']    += row['total_cents']
+
+    return sorted(merged.values(), key=lambda group: (-group['total_quantity'], group['product_id']))
+
+
+def has_shopping_cart_statement(user_id: int):
+    return select(exists().where(ShoppingCart.user_id == user_id))
+
+
+def add_snapshot_statement(product_id: int, product: dict):
+    """
+     INSERT .. ON CONFLICT DO NOTHING RETURNING id, returns no row when the same snapshot already exists
+    """
+    table = ProductSnapshot.__table__
+    return insert(table).values(
+        product_id   = product_id,
+        content_hash = snapshot_hash(product),
+        title        = product['title'],
+        description  = product['description'],
+        price        = product['price'],
+    ).on_conflict_do_nothing(index_elements=[table.c.product_id, table.c.content_hash]).returning(table.c.id)
+
+
+def find_snapshot_statement(product_id: int, product: dict):
+    return select(ProductSnapshot.id).where(ProductSnapshot.product_id == product_id,
+                                            ProductSnapshot.content_hash == snapshot_hash(product))
+
+
+def add_product_statement(user_id: int, product_id: int, snapshot_id: int):
+    """
+     INSERT .. ON CONFLICT DO NOTHING RETURNING .., returns no row when the product is already in the cart
+    """
+    table = ShoppingCart.__table__
+    return insert(table).values(
+        user_id     = user_id,
+        product_id  = product_id,
+        snapshot_id = snapshot_id,
+        quantity    = 1
+    ).on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.product_id]).returning(*table.c)
+
+
+def delete_product_statement(user_id: int, product_id: int):
+    """
+     DELETE .. RETURNING the snapshot id of the deleted line
+    """
+    table = ShoppingCart.__table__
+    return delete(table).where(table.c.user_id == user_id, table.c.product_id == product_id).returning(table.c.snapshot_id)
+
+
+def delete_cart_statement(user_id: int):
+    """
+     DELETE .. RETURNING the snapshot ids of the deleted lines
+    """
+    table = ShoppingCart.__table__
+    return delete(table).where(table.c.user_id == user_id).returning(table.c.snapshot_id)
+
+
+def delete_orphan_snapshots_statement(snapshot_ids):
+    """
+     DELETE of the snapshots among `snapshot_ids` that no cart line uses any more
+    """
+    table = ProductSnapshot.__table__
+    return delete(table).where(table.c.id.in_(snapshot_ids), ~exists().where(ShoppingCart.snapshot_id == table.c.id))
+
+
+def change_quantity_statement(user_id: int, product_id: int, quantity: int):
+    table = ShoppingCart.__table__
+    return update(table).where(table.c.user_id == user_id, table.c.product_id == product_id).values(quantity=quantity)
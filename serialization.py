@@ -0,0 +1,126 @@
+import gzip
+import json
+from calendar import timegm
+from collections.abc import Mapping
+from email.utils import formatdate
+
+from flask_restful import fields
+
+# Optional encoders, the stdlib is used (or the format isn't offered) without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#
+# Response serialization
+#
+# `compile_fields` turns a flask_restful fields dict into a function giving the same output as
+# `marshal` for one object, without looking every field up and instantiating it per value.
+# Bodies are encoded as JSON (orjson when installed) or MessagePack and compressed with brotli
+# or gzip when the client accepts it and they are big enough.
+#
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+
+def _integer(field):
+    default = field.default
+    return lambda value: default if value is None else int(value)
+
+
+def _float(field):
+    default = field.default
+    return lambda value: default if value is None else float(value)
+
+
+def _string(field):
+    default = field.default
+    return lambda value: default if value is None else str(value)
+
+
+def _datetime(field):
+    default = field.default
+    if field.dt_format == 'iso8601':
+        return lambda value: default if value is None else value.isoformat()
+    return lambda value: default if value is None else formatdate(timegm(value.utctimetuple()))
+
+
+# Field classes with a formatter of their own, other fields go through their `output`
+FORMATTERS = {
+    fields.Integer:  _integer,
+    fields.Float:    _float,
+    fields.String:   _string,
+    fields.DateTime: _datetime,
+}
+
+
+def compile_fields(shape: dict):
+    """
+     Serializer of a single object (a result row, a dict or any object) in the `shape` of a fields dict
+    """
+    compiled = []
+    for key, field in shape.items():
+        field = field() if isinstance(field, type) else field
+        if type(field) in FORMATTERS and field.attribute is None:
+            compiled.append((key, FORMATTERS[type(field)](field), None))
+        else:
+            compiled.append((key, None, field))
+
+    def serialize(obj) -> dict:
+        values = obj._mapping if hasattr(obj, '_mapping') else obj
+        get    = values.get if isinstance(values, Mapping) else lambda key: getattr(values, key, None)
+
+        return {key: formatter(get(key)) if formatter is not None else field.output(key, obj)
+                for key, formatter, field in compiled}
+
+    return serialize
+
+
+def dumps_json(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def dumps_msgpack(data) -> bytes:
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def compress_response(response, accept_encodings, min_size: int, gzip_level: int = 5, brotli_quality: int = 4):
+    """
+     Compress the body of `response` with the best encoding the client accepts, when it's at least `min_size` bytes
+
+     Streamed and already encoded responses are left alone. A strong ETag becomes weak, the
+     compressed bytes differ from the identity ones but the content is the same.
+    """
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers \
+            or response.status_code != 200 or response.content_length is None or response.content_length < min_size:
+        return response
+
+    encoding = accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+    response.set_data(brotli.compress(body, quality=brotli_quality) if encoding == 'br'
+                      else gzip.compress(body, compresslevel=gzip_level))
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
@@ -0,0 +1,132 @@
+import collections
+
+from sqlalchemy import delete, func, select, union
+from sqlalchemy.dialects.sqlite import insert
+
+from logger import logger_factory
+from shopping_cart import CartTotals, CartVersion, ProductSnapshot, ShoppingCart
+from repositories import price_cents
+
+logger = logger_factory(__name__)
+
+#
+# Moves the shopping carts to the shard their user maps to
+#
+# Used to split the main database into shards and after appending shards to CART_SHARDS.
+# Run it while the app is stopped. Every batch of users is copied in one transaction and only
+# then removed from its source, so an interrupted run can simply be started again.
+#
+
+
+def rebalance(router, extra_sources=(), batch_size: int = 500) -> dict:
+    """
+     Move every cart that isn't in the shard of its user
+
+     The sources are the shards of `router` and `extra_sources`, e.g. the main database the carts
+     lived in before sharding. Returns the number of users and cart lines moved to every shard.
+    """
+    report  = collections.defaultdict(lambda: {'users': 0, 'lines': 0})
+    sources = list(enumerate(router.engines)) + [(None, engine) for engine in extra_sources]
+
+    for source_index, source in sources:
+        with source.connect() as conn:
+            user_ids = conn.execute(union(select(ShoppingCart.user_id), select(CartVersion.user_id),
+                                          select(CartTotals.user_id))).scalars().all()
+
+        moves = collections.defaultdict(list)
+        for user_id in user_ids:
+            target = router.shard_for(user_id)
+            if target != source_index:
+                moves[target].append(user_id)
+
+        for target, users in moves.items():
+            for start in range(0, len(users), batch_size):
+                batch = users[start:start + batch_size]
+                report[target]['users'] += len(batch)
+                report[target]['lines'] += move_carts(source, router.engines[target], batch)
+
+        if moves:
+            with source.begin() as conn:
+                orphans = conn.execute(delete(ProductSnapshot).where(ProductSnapshot.id.not_in(select(ShoppingCart.snapshot_id)))).rowcount
+            logger.warning(f"Moved {sum(len(users) for users in moves.values())} carts out of {source.url}, "
+                           f"removed {orphans} unused product snapshots")
+
+    return dict(report)
+
+
+def move_carts(source, target, user_ids: list) -> int:
+    """
+     Copy the carts of `user_ids` from the `source` engine to `target`, then delete them from `source`
+
+     Product snapshots are matched by content in the target, cart versions go past the highest of
+     both sides so cached ETags don't match any more and totals are recomputed from the moved lines.
+     Returns the number of lines moved.
+    """
+    with source.connect() as conn:
+        lines = conn.execute(select(
+            ShoppingCart.user_id, ShoppingCart.product_id, ShoppingCart.quantity, ShoppingCart.auto_date,
+            ProductSnapshot.content_hash, ProductSnapshot.title, ProductSnapshot.description, ProductSnapshot.price,
+        ).join(ProductSnapshot, ProductSnapshot.id == ShoppingCart.snapshot_id).where(ShoppingCart.user_id.in_(user_ids))).all()
+        versions = conn.execute(select(CartVersion.user_id, CartVersion.version).where(CartVersion.user_id.in_(user_ids))).all()
+
+    with target.begin() as conn:
+        if lines:
+            snapshots = {(line.product_id, line.content_hash): line for line in lines}
+            table     = ProductSnapshot.__table__
+            conn.execute(insert(table).on_conflict_do_nothing(index_elements=[table.c.product_id, table.c.content_hash]), [{
+                'product_id':   product_id,
+                'content_hash': content_hash,
+                'title':        line.title,
+                'description':  line.description,
+                'price':        line.price,
+            } for (product_id, content_hash), line in snapshots.items()])
+
+            snapshot_ids = {(row.product_id, row.content_hash): row.id for row in conn.execute(
+                select(ProductSnapshot.id, ProductSnapshot.product_id, ProductSnapshot.content_hash)
+                .where(ProductSnapshot.product_id.in_({line.product_id for line in lines})))}
+
+            table = ShoppingCart.__table__
+            conn.execute(insert(table).on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.product_id]), [{
+                'user_id':     line.user_id,
+                'product_id':  line.product_id,
+                'snapshot_id': snapshot_ids[(line.product_id, line.content_hash)],
+                'quantity':    line.quantity,
+                'auto_date':   line.auto_date,
+            } for line in lines])
+
+        if versions:
+            table     = CartVersion.__table__
+            statement = insert(table)
+            conn.execute(statement.on_conflict_do_update(index_elements=[table.c.user_id], set_={
+                'version': func.max(table.c.version, statement.excluded.version) + 1,
+            }), [{'user_id': user_id, 'version': version + 1} for user_id, version in versions])
+
+        # Same as `migrations.add_cart_totals`, for the moved users only
+        table = CartTotals.__table__
+        conn.execute(delete(table).where(table.c.user_id.in_(user_ids)))
+        conn.execute(insert(table).from_select(['user_id', 'item_count', 'total_quantity', 'total_cents'], select(
+            ShoppingCart.user_id,
+            func.count(),
+            func.sum(ShoppingCart.quantity),
+            func.sum(ShoppingCart.quantity * price_cents(ProductSnapshot.price)),
+        ).join(ProductSnapshot, ProductSnapshot.id == ShoppingCart.snapshot_id)
+            .where(ShoppingCart.user_id.in_(user_ids)).group_by(ShoppingCart.user_id)))
+
+    with source.begin() as conn:
+        for model in (ShoppingCart, CartVersion, CartTotals):
+            conn.execute(delete(model).where(model.user_id.in_(user_ids)))
+
+    return len(lines)
+
+
+if __name__ == '__main__':
+    from shopping_cart import db, migrate_databases, shards
+
+    if shards is None:
+        raise SystemExit("CART_SHARDS isn't set, there's nothing to rebalance")
+
+    migrate_databases()
+
+    # The main database is a source too unless it's also one of the shards
+    extra_sources = [db.engine] if db.engine.url not in [engine.url for engine in shards.engines] else []
+    print(rebalance(shards, extra_sources))
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+#
+# Horizontal partitioning of the shopping carts by user id
+#
+# Every shard is a database bind holding the carts (lines, product snapshots, versions, totals)
+# of the users that map to it. The catalog mirror stays in the main database, shard sessions
+# read it from there. Shards must only ever be appended to the list: with a jump consistent
+# hash, going from N to N+1 shards only moves ~1/(N+1) of the users.
+#
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+     Bucket of `key` among `buckets` (Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm")
+
+     Stable across processes and Python versions, unlike `hash()`.
+    """
+    key       &= 0xFFFFFFFFFFFFFFFF
+    bucket, j  = -1, 0
+
+    while j < buckets:
+        bucket = j
+        key    = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j      = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+
+    return bucket
+
+
+class ShardRouter():
+    def __init__(self, engines: list, shard_models, shared_binds: dict, scopefunc=None):
+        """
+         Route sessions to the shard of a user
+
+         `shard_models` live in every shard, `shared_binds` maps the other models to their engine
+         (the catalog mirror to the main database). Per-request sessions are scoped with `scopefunc`,
+         the same one as the main session, and have to be removed when the request ends.
+        """
+        self.engines    = list(engines)
+        self._factories = [sessionmaker(binds={**shared_binds, **{model: engine for model in shard_models}})
+                           for engine in self.engines]
+        self.sessions   = [scoped_session(factory, scopefunc=scopefunc) for factory in self._factories]
+        self._executor  = ThreadPoolExecutor(max_workers=len(self.engines), thread_name_prefix='shard-scatter')
+
+
+    def shard_for(self, user_id: int) -> int:
+        return jump_hash(int(user_id), len(self.engines))
+
+
+    def session(self, user_id: int):
+        """
+         Request session of the user's shard
+        """
+        return self.sessions[self.shard_for(user_id)]
+
+
+    def scatter(self, operation) -> list:
+        """
+         Run `operation(session)` on every shard at the same time and return the results in shard order
+
+         Every call gets its own short-lived session, the first exception raised is re-raised.
+        """
+        def run(factory):
+            with factory() as session:
+                return operation(session)
+
+        futures = [self._executor.submit(run, factory) for factory in self._factories]
+        return [future.result() for future in futures]
+
+
+    def remove(self):
+        for session in self.sessions:
+            session.remove()
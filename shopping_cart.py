@@ -1,22 +1,110 @@
 import datetime
+import os
+import re
+import sys
+import threading
 from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Api, Resource, fields
-from flask import Flask, make_response, request
+from flask import Flask, Response, make_response, request, stream_with_context
 import requests
 import random
-from logger import logger_factory
-from repositories import *
+from cache import TTLCache
+from logger import get_request_id, logger_factory, set_request_id
+from metrics import SamplingProfiler, catalog_cache, group_commit, instrument, instrument_engine, metrics_response, timed
+from migrations import migrate
+from serialization import MSGPACK_MIMETYPE, compress_response, dumps_json, dumps_msgpack, msgpack
+from sharding import ShardRouter
+from storage import GroupCommitter, configure_engine, engine_options
+from upstream import UpstreamClient, UpstreamUnavailableException
 from flask_cors import CORS
 
+if __name__ == '__main__':
+    # `repositories` imports this module back, when run as a script it has to get this copy
+    # instead of loading a second one with its own app, database and exception classes
+    sys.modules['shopping_cart'] = sys.modules['__main__']
+
 
 app = Flask(__name__)
 api = Api(app)
 CORS(app, resources={r"*": {"origins": "*"}})
 logger = logger_factory(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///shopping_cart_db.sqlite3' # db.sqlite3 is the database name, aka. file name
+app.config['SQLALCHEMY_DATABASE_URI']     = os.environ.get('CART_DATABASE_URI', 'sqlite:///shopping_cart_db.sqlite3') # db.sqlite3 is the database name, aka. file name
+app.config['CART_STORAGE_MODE']           = os.environ.get('CART_STORAGE_MODE', 'default') # 'production' turns on WAL, tuned pragmas and a sized pool
+app.config['CART_GROUP_COMMIT_WINDOW_MS'] = float(os.environ.get('CART_GROUP_COMMIT_WINDOW_MS', 0)) # batch concurrent cart writes into one transaction, 0 disables it
+app.config['CART_BODY_CACHE_SIZE']        = int(os.environ.get('CART_BODY_CACHE_SIZE', 0)) # serialized carts kept in memory by (user, version), 0 disables it
+app.config['SQLALCHEMY_ENGINE_OPTIONS']   = engine_options(app.config['CART_STORAGE_MODE'], pool_size=int(os.environ.get('CART_DB_POOL_SIZE', 10)))
+app.config['CART_SHARDS']                 = [uri for uri in os.environ.get('CART_SHARDS', '').split(',') if uri] # spread the carts over these databases by user id, empty keeps them in the main one
+app.config['SQLALCHEMY_BINDS']            = {f'shard{index}': uri for index, uri in enumerate(app.config['CART_SHARDS'])}
 app.app_context().push()
 db = SQLAlchemy(app)
+for engine in db.engines.values():
+    configure_engine(engine, app.config['CART_STORAGE_MODE'])
+
+# Request metrics on /metrics, requests slower than CART_PROFILE_SLOW_MS are profiled into CART_PROFILE_FILE
+app.config['CART_PROFILE_SLOW_MS']     = float(os.environ.get('CART_PROFILE_SLOW_MS', 0)) # 0 disables the profiler
+app.config['CART_PROFILE_SAMPLE_RATE'] = float(os.environ.get('CART_PROFILE_SAMPLE_RATE', 1)) # share of the requests profiled
+app.config['CART_PROFILE_FILE']        = os.environ.get('CART_PROFILE_FILE', 'slow_requests.log')
+profiler = SamplingProfiler(app.config['CART_PROFILE_FILE'], app.config['CART_PROFILE_SLOW_MS'], app.config['CART_PROFILE_SAMPLE_RATE']) \
+    if app.config['CART_PROFILE_SLOW_MS'] else None
+instrument(app, db.engine, profiler)
+for bind in app.config['SQLALCHEMY_BINDS']:
+    instrument_engine(db.engines[bind])
+
+# Client supplied request ids are only kept when they look like one
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+
+@app.before_request
+def tag_request():
+    """
+     Log records of the request carry its id, the client's X-Request-ID when it sent a usable one
+    """
+    request_id = request.headers.get('X-Request-ID', '')
+    set_request_id(request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else None)
+
+
+@app.after_request
+def add_request_id(response):
+    response.headers['X-Request-ID'] = get_request_id()
+    return response
+
+# Data is sent as JSON, or MessagePack when the client prefers it, and compressed from CART_COMPRESS_MIN_SIZE bytes on
+app.config['CART_COMPRESS_MIN_SIZE'] = int(os.environ.get('CART_COMPRESS_MIN_SIZE', 1024)) # 0 disables compression
+
+
+def _output(dumps, data, code, headers):
+    with timed('serialize'):
+        response = make_response(dumps(data), code)
+    response.headers.extend(headers or {})
+    response.vary.add('Accept')
+    return response
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    return _output(dumps_json, data, code, headers)
+
+
+if msgpack is not None:
+    @api.representation(MSGPACK_MIMETYPE)
+    def output_msgpack(data, code, headers=None):
+        return _output(dumps_msgpack, data, code, headers)
+
+
+def negotiated_format() -> str:
+    """
+     Format of the body `api.make_response` gives the client of this request, 'json' or 'msgpack'
+    """
+    mediatype = request.accept_mimetypes.best_match(api.representations, default=api.default_mediatype)
+    return 'msgpack' if mediatype == MSGPACK_MIMETYPE else 'json'
+
+
+if app.config['CART_COMPRESS_MIN_SIZE']:
+    @app.after_request
+    def compress(response):
+        with timed('compress'):
+            return compress_response(response, request.accept_encodings, app.config['CART_COMPRESS_MIN_SIZE'])
 
 class ModelNotFoundException(Exception):
     """
@@ -25,13 +113,155 @@ class ModelNotFoundException(Exception):
     pass
 
 # API URLs
-get_single_user_url    = 'https://fakestoreapi.com/users/'
-get_single_product_url = 'https://fakestoreapi.com/products/'
+catalog_api_url        = os.environ.get('CATALOG_API_URL', 'https://fakestoreapi.com/')
+get_single_user_url    = catalog_api_url + 'users/'
+get_single_product_url = catalog_api_url + 'products/'
+
+# Keep a local copy of the users/products in the database, refreshed every N seconds. 0 disables it
+app.config['CATALOG_MIRROR_INTERVAL'] = int(os.environ.get('CATALOG_MIRROR_INTERVAL', 0))
+
+# Carts without a new line for CART_EXPIRY_DAYS are deleted every CART_EXPIRY_INTERVAL seconds, CART_EXPIRY_BATCH_SIZE at a time
+app.config['CART_EXPIRY_DAYS']       = float(os.environ.get('CART_EXPIRY_DAYS', 0)) # 0 disables it
+app.config['CART_EXPIRY_INTERVAL']   = int(os.environ.get('CART_EXPIRY_INTERVAL', 3600))
+app.config['CART_EXPIRY_BATCH_SIZE'] = int(os.environ.get('CART_EXPIRY_BATCH_SIZE', 500))
+
+# Serialized carts by user and cart version, a new version makes the old entries unreachable
+cart_body_cache = TTLCache(maxsize=app.config['CART_BODY_CACHE_SIZE'], ttl=3600) if app.config['CART_BODY_CACHE_SIZE'] else None
+
+# Shared pooled client for the catalog API
+catalog_client = UpstreamClient('catalog', pool_size=20, connect_timeout=3.05, read_timeout=10, retries=2)
+
+# Catalog caches, users and products barely change so we keep them around for a while.
+# "Does not exist" answers are cached for a shorter time.
+user_cache    = TTLCache(maxsize=10000, ttl=300, negative_ttl=30)
+product_cache = TTLCache(maxsize=10000, ttl=300, negative_ttl=30)
+
+
+@timed('catalog_product')
+def get_single_product(product_id, db_session=None):
+    """
+     Look the product up in the local mirror when `db_session` is given, in the external API otherwise or on a miss
+    """
+    product = _get_mirrored(db_session, CatalogProduct, product_id)
+    if product is not None:
+        return product
+
+    return product_cache.get_or_load(int(product_id), lambda: _fetch_single_product(product_id),
+                                     negative=ModelNotFoundException)
+
+
+@timed('catalog_user')
+def get_single_user(user_id, db_session=None):
+    """
+     Look the user up in the local mirror when `db_session` is given, in the external API otherwise or on a miss
+    """
+    user = _get_mirrored(db_session, CatalogUser, user_id)
+    if user is not None:
+        return user
+
+    return user_cache.get_or_load(int(user_id), lambda: _fetch_single_user(user_id),
+                                  negative=ModelNotFoundException)
+
+
+def get_user_and_product(user_id, product_id, db_session=None):
+    """
+     Fetch a user and a product at the same time
+
+     Errors about the user take precedence, just like when fetching them one after the other.
+    """
+    # The local mirror is read from this thread, only misses go to the worker pool
+    user        = _get_mirrored(db_session, CatalogUser, user_id)
+    user_future = catalog_client.submit(get_single_user, user_id) if user is None else None
+
+    product_error = None
+    try:
+        product = get_single_product(product_id, db_session)
+    except Exception as e:
+        product_error = e
+
+    if user_future is not None:
+        user = user_future.result()
+
+    if product_error is not None:
+        raise product_error
+
+    return user, product
+
+
+def get_products(product_ids, db_session=None):
+    """
+     Fetch several products at the same time
 
+     Returns a dict of product id -> product, or the exception raised while fetching it.
+    """
+    products = {}
+    futures  = {}
+
+    for product_id in set(product_ids):
+        product = _get_mirrored(db_session, CatalogProduct, product_id)
+        if product is not None:
+            products[product_id] = product
+        else:
+            futures[product_id] = catalog_client.submit(get_single_product, product_id)
+
+    for product_id, future in futures.items():
+        try:
+            products[product_id] = future.result()
+        except (ModelNotFoundException, UpstreamUnavailableException) as e:
+            products[product_id] = e
+
+    return products
+
+
+def cart_session(user_id: int):
+    """
+     Session of the database holding the user's shopping cart
+    """
+    return db.session if shards is None else shards.session(user_id)
+
+
+def write_product(user_id: int, product_id: int, action: str, *args):
+    """
+     Run a ProductRepository write (add, delete, change_quantity)
+
+     With group commit on, the user and product are validated in the calling thread and the write
+     itself joins the next group transaction of the user's database.
+    """
+    if not group_committers:
+        return getattr(ProductRepository(cart_session(user_id), user_id, product_id), action)(*args)
+
+    session       = cart_session(user_id)
+    user, product = get_user_and_product(user_id, product_id, session)
+    # The mirror lookups opened a read transaction on the request session. Its lock would keep the
+    # group's COMMIT waiting while this thread waits for the group, end it first.
+    session.close()
+    group_committer = group_committers[shards.shard_for(user_id) if shards is not None else 0]
+
+    def operation(session):
+        repository = ProductRepository(session, user_id, product_id, user=user, product=product, autocommit=False)
+        return getattr(repository, action)(*args)
+
+    return group_committer.submit(operation)
 
-def get_single_product(product_id):
+
+def catalog_cache_stats():
+    """
+     Hit/miss/eviction counters of the catalog caches
+    """
+    return {'users': user_cache.stats(), 'products': product_cache.stats()}
+
+
+def _get_mirrored(db_session, model, model_id):
+    if db_session is None or not app.config['CATALOG_MIRROR_INTERVAL']:
+        return None
+
+    row = db_session.get(model, int(model_id))
+    return row.data if row is not None else None
+
+
+def _fetch_single_product(product_id):
     url = get_single_product_url + str(product_id)
-    r   = requests.get(url)
+    r   = catalog_client.get(url)
 
     if r.content == b'' or r.content == 'null':
         raise ModelNotFoundException(f"Product #{product_id} does not exist!")
@@ -40,28 +270,128 @@ def get_single_product(product_id):
 
 
 
-def get_single_user(user_id):
+def _fetch_single_user(user_id):
     url = get_single_user_url + str(user_id)
-    r   = requests.get(url)
+    r   = catalog_client.get(url)
 
     if r.content == b'' or r.content == 'null':
         raise ModelNotFoundException(f"User #{user_id} does not exist!")
 
     return r.json()
 
+class ProductSnapshot(db.Model):
+    """
+     Product details as they were when added to a shopping cart, shared by every cart line with the same content
+    """
+    __tablename__  = 'product_snapshots'
+    __table_args__ = (
+        db.Index('ix_product_snapshots_product_hash', 'product_id', 'content_hash', unique=True),
+    )
+
+    id            = db.Column('id', db.Integer, primary_key=True)
+    product_id    = db.Column('product_id', db.Integer, nullable=False)
+    content_hash  = db.Column('content_hash', db.String, nullable=False)
+
+    title         = db.Column('title', db.String)
+    description   = db.Column('description', db.String)
+    price         = db.Column('price', db.Float)
+
 class ShoppingCart(db.Model):
+    __table_args__ = (
+        # A product can only be once in a user's shopping cart, also serves every `filter_by(user_id=...)`
+        db.Index('ix_shopping_cart_user_product', 'user_id', 'product_id', unique=True),
+        db.Index('ix_shopping_cart_product_id', 'product_id'),
+        # Keyset pagination of a user's cart by id
+        db.Index('ix_shopping_cart_user_id_id', 'user_id', 'id'),
+        # Finding stale carts for `cart_expiry`
+        db.Index('ix_shopping_cart_auto_date', 'auto_date'),
+        # Finding the product snapshots no line uses any more
+        db.Index('ix_shopping_cart_snapshot_id', 'snapshot_id'),
+    )
+
     id            = db.Column('id', db.Integer, primary_key=True, auto_increment=True)
     user_id       = db.Column('user_id', db.Integer)
-    username      = db.Column('username', db.String)
 
     product_id    = db.Column('product_id', db.Integer)
-    product_title = db.Column('product_title', db.String)
-    product_desc  = db.Column('product_desc', db.String)
-    product_price = db.Column('product_price', db.Integer)
+    snapshot_id   = db.Column('snapshot_id', db.Integer, db.ForeignKey('product_snapshots.id'), nullable=False)
 
     quantity      = db.Column('quantity', db.Integer)
     auto_date     = db.Column('auto_date', db.DateTime, default=datetime.datetime.now)
 
+class CatalogUser(db.Model):
+    """
+     Local mirror of the users API, kept fresh by `catalog_mirror.CatalogRefresher`
+    """
+    __tablename__ = 'users'
+
+    id            = db.Column('id', db.Integer, primary_key=True, autoincrement=False)
+    username      = db.Column('username', db.String)
+    data          = db.Column('data', db.JSON, nullable=False)
+    content_hash  = db.Column('content_hash', db.String, nullable=False)
+    synced_at     = db.Column('synced_at', db.DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+class CatalogProduct(db.Model):
+    """
+     Local mirror of the products API, kept fresh by `catalog_mirror.CatalogRefresher`
+    """
+    __tablename__ = 'products'
+
+    id            = db.Column('id', db.Integer, primary_key=True, autoincrement=False)
+    title         = db.Column('title', db.String)
+    price         = db.Column('price', db.Float)
+    data          = db.Column('data', db.JSON, nullable=False)
+    content_hash  = db.Column('content_hash', db.String, nullable=False)
+    synced_at     = db.Column('synced_at', db.DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+class CartVersion(db.Model):
+    """
+     Bumped by every change to a user's shopping cart, GET requests use it as their ETag
+    """
+    __tablename__ = 'cart_versions'
+
+    user_id       = db.Column('user_id', db.Integer, primary_key=True, autoincrement=False)
+    version       = db.Column('version', db.Integer, nullable=False, default=0)
+
+class CartTotals(db.Model):
+    """
+     Per-user aggregates of the shopping cart, updated by every cart write in the same transaction
+    """
+    __tablename__  = 'cart_totals'
+    __table_args__ = (
+        # Carts by value
+        db.Index('ix_cart_totals_total_cents', 'total_cents'),
+    )
+
+    user_id        = db.Column('user_id', db.Integer, primary_key=True, autoincrement=False)
+    item_count     = db.Column('item_count', db.Integer, nullable=False, default=0)
+    total_quantity = db.Column('total_quantity', db.Integer, nullable=False, default=0)
+    total_cents    = db.Column('total_cents', db.Integer, nullable=False, default=0) # sum of quantity * price, in cents so increments stay exact
+
+# Models stored in every shard, the catalog mirror stays in the main database
+CART_MODELS = (ProductSnapshot, ShoppingCart, CartVersion, CartTotals)
+
+shards = ShardRouter([db.engines[bind] for bind in app.config['SQLALCHEMY_BINDS']], CART_MODELS,
+                     {CatalogUser: db.engine, CatalogProduct: db.engine}, scopefunc=db.session.registry.scopefunc) \
+    if app.config['CART_SHARDS'] else None
+
+if shards is not None:
+    @app.teardown_appcontext
+    def remove_shard_sessions(exception=None):
+        shards.remove()
+
+# Cart writes from concurrent requests share transactions when group commit is on, one committer per database
+group_committers = [GroupCommitter(app, session, window=app.config['CART_GROUP_COMMIT_WINDOW_MS'] / 1000, mapper=ShoppingCart)
+                    for session in (shards.sessions if shards is not None else [db.session])] \
+    if app.config['CART_GROUP_COMMIT_WINDOW_MS'] else []
+
+
+def migrate_databases() -> list:
+    """
+     Bring the main database and every shard up to the latest schema
+    """
+    return [migrate(engine, db.metadata) for engine in db.engines.values()]
+
+
 shopping_cart_fields = {
     'id': fields.Integer,
 
@@ -78,16 +408,62 @@ shopping_cart_fields = {
     'auto_date': fields.DateTime,
 }
 
+cart_summary_fields = {
+    'user_id': fields.Integer,
+    'item_count': fields.Integer,
+    'total_quantity': fields.Integer,
+    'total_value': fields.Float,
+}
+
+
 
 
+# The repositories import the models and catalog functions above
+from repositories import *
+
 
 class HandleShoppingCart(Resource):
     def get(self, user_id: int):
         """
         Return the entire shopping cart of a specific user
+
+        Answers `If-None-Match` with a 304 from the cart version once the user and the cart are known to
+        exist, without loading the cart
+
+        Query string:
+         - fields: comma separated fields to return, all of them by default
+         - limit, after: return one page of `limit` lines after the line with id `after`
+         - stream: when true, serialize the lines as they come from the database, always as JSON
         """
+        fields  = [field for field in request.args.get('fields', '').split(',') if field] or None
+        limit   = request.args.get('limit', type=int)
+        after   = request.args.get('after', type=int)
+        stream  = request.args.get('stream', '').lower() in ('1', 'true')
+
         try:
-            response = ShoppingCartRepository(db.session, user_id).get()
+            repository = ShoppingCartRepository(cart_session(user_id), user_id)
+
+            # The bodies in the cache are encoded per request, so every format shares the entry of a version
+            version = f"{user_id}-{get_cart_version(cart_session(user_id), user_id)}"
+            etag    = f"{version}-{'json' if stream else negotiated_format()}"
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                response.vary.add('Accept')
+                return response
+
+            if stream:
+                response = self._stream(repository.stream(fields))
+            elif limit is not None or after is not None:
+                items, next_cursor = repository.page(after, 50 if limit is None else limit, fields)
+                response           = {'items': items, 'next_cursor': next_cursor}
+            elif fields:
+                response = repository.get(fields)
+            elif cart_body_cache is None:
+                response = repository.get()
+            else:
+                response = cart_body_cache.get_or_load(version, repository.get)
 
         except UserDoesNotHaveAShoppingCartException as e:
             return make_response(str(e), 404)
@@ -95,7 +471,38 @@ class HandleShoppingCart(Resource):
         except ModelNotFoundException as e:
             return make_response(str(e), 404)
 
-        return make_response(response, 200)
+        except UpstreamUnavailableException as e:
+            return make_response(str(e), 503)
+
+        except InvalidCartQueryException as e:
+            return make_response(str(e), 400)
+
+        # Streamed bodies are already a response
+        response = response if stream else api.make_response(response, 200)
+        response.set_etag(etag)
+        return response
+
+
+    @staticmethod
+    def _stream(lines):
+        """
+         Stream the lines as a JSON array, validation errors are raised before the response starts
+
+         Streamed responses are always JSON and never compressed.
+        """
+        first = next(lines, None)
+
+        def generate():
+            if first is None:
+                yield b'[]'
+                return
+
+            yield b'[' + dumps_json(first)
+            for line in lines:
+                yield b',' + dumps_json(line)
+            yield b']'
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
 
 
     def delete(self, user_id: int):
@@ -104,12 +511,15 @@ class HandleShoppingCart(Resource):
         """
 
         try:
-            ShoppingCartRepository(db.session, user_id).delete()
+            ShoppingCartRepository(cart_session(user_id), user_id).delete()
         except UserDoesNotHaveAShoppingCartException as e:
             return make_response(str(e), 404)
         except ModelNotFoundException as e:
             return make_response(str(e), 404)
 
+        except UpstreamUnavailableException as e:
+            return make_response(str(e), 503)
+
     
         return make_response(f"Shopping cart of user #{user_id} has been deleted!", 204)
 
@@ -121,10 +531,13 @@ class HandleProduct(Resource):
          Add a specific product to a specific user's shopping cart
         """
         try:
-            ProductRepository(db.session, user_id, product_id).add()
+            write_product(user_id, product_id, 'add')
         except ModelNotFoundException as e:
             return make_response(str(e), 404)
 
+        except UpstreamUnavailableException as e:
+            return make_response(str(e), 503)
+
         except ProductAlreadyInShoppingCartException as e:
             return make_response(str(e), 400)
 
@@ -141,10 +554,13 @@ class HandleProduct(Resource):
          Delete a specific product from a specific user's shopping cart
         """
         try:
-            ProductRepository(db.session, user_id, product_id).delete()
+            write_product(user_id, product_id, 'delete')
         except ModelNotFoundException as e:
             return make_response(str(e), 404)
 
+        except UpstreamUnavailableException as e:
+            return make_response(str(e), 503)
+
         except ProductAlreadyInShoppingCartException as e:
             return make_response(str(e), 400)
 
@@ -161,10 +577,13 @@ class HandleProduct(Resource):
          Change the quantity of a specific product from a specific user's shopping cart
         """
         try:
-            ProductRepository(db.session, user_id, product_id).change_quantity(request.json['quantity'])
+            write_product(user_id, product_id, 'change_quantity', request.json['quantity'])
         except ModelNotFoundException as e:
             return make_response(str(e), 404)
 
+        except UpstreamUnavailableException as e:
+            return make_response(str(e), 503)
+
         except ProductAlreadyInShoppingCartException as e:
             return make_response(str(e), 400)
 
@@ -181,13 +600,186 @@ class HandleProduct(Resource):
 
 
 
+class HandleCartBatch(Resource):
+    # Operation -> (status code, message) when it succeeds, same as the single item routes
+    SUCCESS = {
+        'add':          (201, "Product #{product_id} has been added to user #{user_id}'s shopping cart!"),
+        'remove':       (204, "Product #{product_id} has been deleted from user #{user_id}'s shopping cart!"),
+        'set_quantity': (200, "Product #{product_id} has been updated in user #{user_id}'s shopping cart!"),
+    }
+
+    def post(self, user_id: int):
+        """
+         Apply a list of add/remove/set_quantity operations to a specific user's shopping cart in one transaction
+        """
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            return make_response("Body must be a JSON object with a list of 'operations'!", 400)
+
+        try:
+            results = CartBatchRepository(cart_session(user_id), user_id).apply(body.get('operations'))
+        except ModelNotFoundException as e:
+            return make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return make_response(str(e), 503)
+
+        except InvalidBatchOperationException as e:
+            return make_response(str(e), 400)
+
+
+        response = []
+        for operation, error in results:
+            if error is None:
+                status, message = self.SUCCESS[operation['op']]
+                message         = message.format(product_id=operation['product_id'], user_id=user_id)
+            elif isinstance(error, ModelNotFoundException):
+                status, message = 404, str(error)
+            elif isinstance(error, UpstreamUnavailableException):
+                status, message = 503, str(error)
+            else:
+                status, message = 400, str(error)
+
+            response.append({
+                'op':         operation.get('op') if isinstance(operation, dict) else None,
+                'product_id': operation.get('product_id') if isinstance(operation, dict) else None,
+                'status':     status,
+                'message':    message,
+            })
+
+        return api.make_response({'results': response}, 200)
+
+
+
+class HandleCartSummary(Resource):
+    def get(self, user_id: int):
+        """
+         Item count, total quantity and total value of a specific user's shopping cart, without its lines
+
+         Answers `If-None-Match` with a 304 once the user and the cart are known to exist
+        """
+        try:
+            repository = ShoppingCartRepository(cart_session(user_id), user_id)
+            etag       = f"{user_id}-{get_cart_version(cart_session(user_id), user_id)}-{negotiated_format()}"
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                response.vary.add('Accept')
+                return response
+
+            response = repository.summary()
+
+        except UserDoesNotHaveAShoppingCartException as e:
+            return make_response(str(e), 404)
+
+        except ModelNotFoundException as e:
+            return make_response(str(e), 404)
+
+        except UpstreamUnavailableException as e:
+            return make_response(str(e), 503)
+
+        response = api.make_response(response, 200)
+        response.set_etag(etag)
+        return response
+
+
+
+class HandleTopProducts(Resource):
+    def get(self):
+        """
+         Products in the most shopping carts, `limit` of them (10 by default)
+        """
+        try:
+            response = CartAggregateRepository(db.session, shards).top_products(request.args.get('limit', 10, type=int))
+        except InvalidCartQueryException as e:
+            return make_response(str(e), 400)
+
+        return api.make_response(response, 200)
+
+
+
+class HandleCartsByValue(Resource):
+    def get(self):
+        """
+         Most valuable shopping carts, `limit` of them (10 by default)
+        """
+        try:
+            response = CartAggregateRepository(db.session, shards).carts_by_value(request.args.get('limit', 10, type=int))
+        except InvalidCartQueryException as e:
+            return make_response(str(e), 400)
+
+        return api.make_response(response, 200)
+
+
+
+class HandleMetrics(Resource):
+    def get(self):
+        """
+         Prometheus metrics: request counts and latencies per route and status, time per stage, cache and group commit counters
+        """
+        for cache, stats in catalog_cache_stats().items():
+            for stat, value in stats.items():
+                catalog_cache.set(value, cache=cache, stat=stat)
+
+        if group_committers:
+            group_commit.set(sum(committer.groups for committer in group_committers), stat='groups')
+            group_commit.set(sum(committer.operations for committer in group_committers), stat='operations')
+
+        return metrics_response()
+
+
+
+
+
 api.add_resource(HandleShoppingCart, '/cart/user/<int:user_id>')
 api.add_resource(HandleProduct,      '/cart/user/<int:user_id>/product/<int:product_id>')
+api.add_resource(HandleCartBatch,    '/cart/user/<int:user_id>/batch')
+api.add_resource(HandleCartSummary,  '/cart/user/<int:user_id>/summary')
+api.add_resource(HandleTopProducts,  '/admin/carts/top-products')
+api.add_resource(HandleCartsByValue, '/admin/carts/by-value')
+api.add_resource(HandleMetrics,      '/metrics')
+
+
+# The catalog mirror refresher and the cart expiry job, once per serving process
+_background_jobs_started = False
+_background_jobs_lock    = threading.Lock()
+
+
+def start_background_jobs():
+    """
+     Start the configured background jobs, if they aren't running yet
+
+     Called on the first request so they run under any server, but not in command line tools importing the app.
+    """
+    global _background_jobs_started
+
+    with _background_jobs_lock:
+        if _background_jobs_started:
+            return
+        _background_jobs_started = True
+
+    if app.config['CATALOG_MIRROR_INTERVAL']:
+        from catalog_mirror import CatalogRefresher
+        CatalogRefresher(app, db, app.config['CATALOG_MIRROR_INTERVAL']).start()
+
+    if app.config['CART_EXPIRY_DAYS']:
+        from cart_expiry import CartExpiry
+        CartExpiry(list(db.engines.values()), datetime.timedelta(days=app.config['CART_EXPIRY_DAYS']),
+                   app.config['CART_EXPIRY_INTERVAL'], app.config['CART_EXPIRY_BATCH_SIZE']).start()
+
+
+@app.before_request
+def ensure_background_jobs():
+    if not _background_jobs_started:
+        start_background_jobs()
 
 
 if __name__ == '__main__':
     # db.destroy_all()
     # db.create_all()
+    migrate_databases()
+    start_background_jobs()
     app.run(debug=True)
 
 
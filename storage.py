@@ -0,0 +1,177 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+from logger import logger_factory
+
+logger = logger_factory(__name__)
+
+#
+# SQLite storage modes
+#
+# default:    SQLite's defaults (rollback journal, full fsync on every commit)
+# production: WAL journal, synchronous=NORMAL, bigger page cache, memory mapped I/O, busy timeout and a sized pool
+#
+
+STORAGE_MODES = ('default', 'production')
+
+PRODUCTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous':  'NORMAL',
+    'cache_size':   -64000,      # KiB, ~64MB
+    'mmap_size':    268435456,   # 256MB
+    'temp_store':   'MEMORY',
+    'busy_timeout': 5000,        # ms
+}
+
+# Execution options of a connection that writes in a transaction it opens itself, see `configure_engine`
+WRITE_TRANSACTION = {'sqlite_begin': 'BEGIN IMMEDIATE'}
+
+
+def engine_options(mode: str, pool_size: int = 10, busy_timeout: float = 5) -> dict:
+    """
+     SQLALCHEMY_ENGINE_OPTIONS for a storage mode
+    """
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode '{mode}', expected one of: {', '.join(STORAGE_MODES)}")
+
+    if mode == 'default':
+        return {}
+
+    return {
+        'poolclass':    QueuePool,
+        'pool_size':    pool_size,
+        'max_overflow': pool_size * 2,
+        'pool_timeout': busy_timeout * 2,
+        'connect_args': {'timeout': busy_timeout, 'check_same_thread': False},
+    }
+
+
+def configure_engine(engine, mode: str):
+    """
+     Install the SQLite connection hooks of a storage mode on `engine`
+
+     Transactions are left to pysqlite, which only opens one before INSERT/UPDATE/DELETE, so reads
+     don't keep a lock while a request waits on the catalog. Connections with a 'sqlite_begin'
+     execution option (see `begin_write`) start theirs with that statement instead.
+    """
+    pragmas = PRODUCTION_PRAGMAS if mode == 'production' else {}
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        begin = conn.get_execution_options().get('sqlite_begin')
+
+        # None turns pysqlite's transaction handling off, '' is its default
+        dbapi_connection = conn.connection.dbapi_connection
+        isolation_level  = None if begin else ''
+        if dbapi_connection.isolation_level != isolation_level:
+            dbapi_connection.isolation_level = isolation_level
+
+        if begin:
+            conn.exec_driver_sql(begin)
+
+
+def begin_write(session, mapper=None):
+    """
+     Start the transaction of `session` on the database of `mapper` with BEGIN IMMEDIATE
+
+     Needed before savepoints: the write lock is taken up front, and SQLAlchemy, not pysqlite,
+     owns the transaction, so releasing a savepoint doesn't commit it. Any transaction the
+     session already has is ended first. Returns the connection.
+    """
+    session.close()
+    return session.connection(bind_arguments={'mapper': mapper}, execution_options=WRITE_TRANSACTION)
+
+
+class GroupCommitter():
+    def __init__(self, app, session, window: float = 0.002, max_batch: int = 64, mapper=None):
+        """
+         Apply write operations from concurrent requests in shared transactions
+
+         Operations queued within `window` seconds of each other (at most `max_batch`) run on one
+         `session` (scoped to the app context), each in its own savepoint, and are committed
+         together: one fsync for the whole group. `mapper` picks the database of the session written to.
+        """
+        self._app       = app
+        self._session   = session
+        self._mapper    = mapper
+        self._window    = window
+        self._max_batch = max_batch
+        self._queue     = queue.Queue()
+
+        self.groups     = 0
+        self.operations = 0
+
+        self._worker    = threading.Thread(target=self._run, name='group-committer', daemon=True)
+        self._worker.start()
+
+
+    def submit(self, operation):
+        """
+         Run `operation(session)` in the next group and return its result once committed
+
+         Exceptions raised by the operation are re-raised here, its savepoint is rolled back.
+        """
+        future = Future()
+        self._queue.put((operation, future))
+        return future.result()
+
+
+    def _run(self):
+        while True:
+            group    = [self._queue.get()]
+            deadline = time.monotonic() + self._window
+
+            while len(group) < self._max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    group.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self._commit_group(group)
+
+
+    def _commit_group(self, group):
+        with self._app.app_context():
+            session = self._session
+            results = []
+
+            try:
+                begin_write(session, self._mapper)
+                for operation, future in group:
+                    try:
+                        with session.begin_nested():
+                            results.append((future, operation(session), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+
+                session.commit()
+            except Exception as e:
+                logger.exception("Group commit failed")
+                session.rollback()
+                results = [(future, None, e) for _, future in group]
+            finally:
+                session.remove()
+
+        self.groups     += 1
+        self.operations += len(group)
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
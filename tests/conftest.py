@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stub_catalog import start_stub
+
+#
+# `shopping_cart` is configured from the environment when it's imported, so every test shares one
+# app, one database in a temporary directory and one stub catalog. Both are emptied between tests.
+#
+
+DATA_DIR = tempfile.mkdtemp(prefix='cart-tests-')
+stub_server, stub_catalog, stub_url = start_stub(users=20, products=50)
+
+os.environ['CART_DATABASE_URI'] = f"sqlite:///{os.path.join(DATA_DIR, 'cart.sqlite3')}"
+os.environ['CATALOG_API_URL']   = stub_url
+os.environ['CART_LOG_FILE']     = os.path.join(DATA_DIR, 'info.log')
+for name in ('CART_SHARDS', 'CART_STORAGE_MODE', 'CART_GROUP_COMMIT_WINDOW_MS', 'CART_BODY_CACHE_SIZE',
+             'CATALOG_MIRROR_INTERVAL', 'CART_EXPIRY_DAYS'):
+    os.environ.pop(name, None)
+
+from flask.globals import app_ctx
+
+import shopping_cart
+from shopping_cart import app, db, migrate_databases
+
+# The app context pushed on import is for command line tools, under a server every request gets its own
+app_ctx._get_current_object().pop()
+
+with app.app_context():
+    migrate_databases()
+
+
+@pytest.fixture
+def stub():
+    """
+     The stub catalog, its latency, errors, users and products are put back after the test
+    """
+    users, products = dict(stub_catalog.users), dict(stub_catalog.products)
+    yield stub_catalog
+
+    stub_catalog.latency_ms = 0
+    stub_catalog.error_rate = 0
+    stub_catalog.users      = users
+    stub_catalog.products   = products
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    yield
+
+    with app.app_context():
+        for engine in db.engines.values():
+            with engine.begin() as conn:
+                for table in reversed(db.metadata.sorted_tables):
+                    conn.execute(table.delete())
+
+    shopping_cart.user_cache.invalidate()
+    shopping_cart.product_cache.invalidate()
+
+
+def count(sql: str) -> int:
+    """
+     Single value of `sql` on the test database, outside of any app session
+    """
+    with app.app_context(), db.engine.connect() as conn:
+        return conn.exec_driver_sql(sql).scalar()
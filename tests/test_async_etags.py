@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip('quart')
+pytest.importorskip('aiosqlite')
+pytest.importorskip('greenlet')
+msgpack = pytest.importorskip('msgpack')
+
+from shopping_cart import app
+
+# It reads the sync app's engines when it's imported
+with app.app_context():
+    import async_shopping_cart
+
+MSGPACK = {'Accept': 'application/msgpack'}
+
+
+@pytest.fixture(scope='module')
+def run():
+    """
+     Run coroutines on one event loop for the whole module, the app's catalog client and engines are bound to it
+    """
+    with asyncio.Runner() as runner:
+        yield runner.run
+        runner.run(async_shopping_cart.shutdown())
+
+
+def test_etags_match_the_sync_app_per_format(client, stub, run):
+    assert client.post('/cart/user/1/product/1').status_code == 201
+
+    async def requests():
+        async_client = async_shopping_cart.app.test_client()
+
+        for path in ('/cart/user/1', '/cart/user/1/summary'):
+            as_json    = await async_client.get(path)
+            as_msgpack = await async_client.get(path, headers=MSGPACK)
+
+            assert as_json.headers['ETag'] == client.get(path).headers['ETag'] == '"1-1-json"'
+            assert as_msgpack.headers['ETag'] == client.get(path, headers=MSGPACK).headers['ETag'] == '"1-1-msgpack"'
+            assert as_msgpack.mimetype == 'application/msgpack'
+            assert msgpack.unpackb(await as_msgpack.get_data()) == json.loads(await as_json.get_data())
+
+            # A tag is only good for its own format, and compression makes it weak
+            response = await async_client.get(path, headers={**MSGPACK, 'If-None-Match': as_json.headers['ETag']})
+            assert response.status_code == 200
+
+            response = await async_client.get(path, headers={**MSGPACK, 'If-None-Match': 'W/"1-1-msgpack"'})
+            assert response.status_code == 304
+            assert 'Accept' in response.headers['Vary']
+
+    run(requests())
+
+
+def test_removed_user_isnt_revalidated(client, stub, run):
+    assert client.post('/cart/user/1/product/1').status_code == 201
+
+    async def requests():
+        async_client = async_shopping_cart.app.test_client()
+        etag         = (await async_client.get('/cart/user/1')).headers['ETag']
+
+        del stub.users[1]
+        async_shopping_cart.catalog.user_cache.invalidate(1)
+
+        for path in ('/cart/user/1', '/cart/user/1/summary'):
+            assert (await async_client.get(path, headers={'If-None-Match': etag})).status_code == 404
+
+    run(requests())
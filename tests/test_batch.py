@@ -0,0 +1,42 @@
+import pytest
+
+import repositories
+from conftest import count
+from repositories import CartBatchRepository
+from shopping_cart import app, cart_session
+
+
+def test_failing_operations_keep_the_others(client, stub):
+    response = client.post('/cart/user/1/batch', json={'operations': [
+        {'op': 'add', 'product_id': 1},
+        {'op': 'add', 'product_id': 10**6},
+        {'op': 'add', 'product_id': 1},
+        {'op': 'set_quantity', 'product_id': 1, 'quantity': 3},
+        {'op': 'remove', 'product_id': 2},
+    ]})
+
+    assert response.status_code == 200
+    assert [result['status'] for result in response.get_json()['results']] == [201, 404, 400, 200, 404]
+
+    assert count("SELECT quantity FROM shopping_cart WHERE user_id = 1 AND product_id = 1") == 3
+    assert count("SELECT COUNT(*) FROM shopping_cart") == 1
+    assert count("SELECT total_quantity FROM cart_totals WHERE user_id = 1") == 3
+    assert count("SELECT total_cents FROM cart_totals WHERE user_id = 1") == 450
+
+
+def test_failed_batch_commits_nothing(stub, monkeypatch):
+    def broken(self, quantity):
+        raise RuntimeError("Lost the database")
+
+    monkeypatch.setattr(repositories.ProductRepository, 'change_quantity', broken)
+
+    with app.app_context(), pytest.raises(RuntimeError):
+        CartBatchRepository(cart_session(1), 1).apply([
+            {'op': 'add', 'product_id': 1},
+            {'op': 'add', 'product_id': 2},
+            {'op': 'set_quantity', 'product_id': 1, 'quantity': 3},
+        ])
+
+    assert count("SELECT COUNT(*) FROM shopping_cart") == 0
+    assert count("SELECT COUNT(*) FROM cart_totals") == 0
+    assert count("SELECT COUNT(*) FROM cart_versions") == 0
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import sys
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import TTLCache
+
+
+class NotFound(Exception):
+    pass
+
+
+def fail():
+    raise NotFound("User #1 does not exist!")
+
+
+def test_negative_hits_raise_a_fresh_exception():
+    cache  = TTLCache(negative_ttl=60)
+    raised = []
+
+    for _ in range(1000):
+        try:
+            cache.get_or_load(1, fail, negative=NotFound)
+        except NotFound as e:
+            raised.append(e)
+
+    assert cache.stats()['misses'] == 1
+    assert len({id(e) for e in raised}) == len(raised)
+    assert str(raised[-1]) == "User #1 does not exist!"
+    assert len(traceback.extract_tb(raised[-1].__traceback__)) < 5
+
+
+def test_async_negative_hits_raise_a_fresh_exception():
+    cache = TTLCache(negative_ttl=60)
+
+    async def afail():
+        fail()
+
+    async def load():
+        try:
+            await cache.aget_or_load(1, afail, negative=NotFound)
+        except NotFound as e:
+            return e
+
+    async def main():
+        return [await load() for _ in range(100)]
+
+    raised = asyncio.run(main())
+
+    assert cache.stats()['misses'] == 1
+    assert len({id(e) for e in raised}) == len(raised)
+    assert len(traceback.extract_tb(raised[-1].__traceback__)) < 5
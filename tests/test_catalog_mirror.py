@@ -0,0 +1,61 @@
+import time
+
+from catalog_mirror import CatalogRefresher
+from conftest import count, stub_url
+from shopping_cart import app, db
+from upstream import UpstreamClient
+
+
+def refresher(interval: float = 60) -> CatalogRefresher:
+    # A client of its own without retries, the stub errors mustn't open the app's circuit breaker
+    return CatalogRefresher(app, db, interval, client=UpstreamClient('catalog-mirror', retries=0), base_url=stub_url)
+
+
+def mirrored_title(product_id: int) -> str:
+    with app.app_context(), db.engine.connect() as conn:
+        return conn.exec_driver_sql(f"SELECT title FROM products WHERE id = {product_id}").scalar()
+
+
+def test_refresh_fills_the_mirror_then_only_writes_changes(stub):
+    mirror = refresher()
+
+    assert mirror.refresh() == {'users':    {'inserted': 20, 'updated': 0, 'removed': 0},
+                                'products': {'inserted': 50, 'updated': 0, 'removed': 0}}
+    assert count("SELECT COUNT(*) FROM products") == 50
+    assert mirrored_title(7) == "Product #7"
+
+    stub.products[7] = {**stub.products[7], 'title': "Renamed"}
+    del stub.products[8]
+
+    assert mirror.refresh()['products'] == {'inserted': 0, 'updated': 1, 'removed': 1}
+    assert mirrored_title(7) == "Renamed"
+    assert count("SELECT COUNT(*) FROM products") == 49
+
+
+def test_failed_refresh_keeps_the_last_copy(stub):
+    mirror = refresher()
+    mirror.refresh()
+
+    stub.products[7] = {**stub.products[7], 'title': "Renamed"}
+    stub.error_rate  = 1
+
+    assert mirror.refresh() is None
+    assert mirrored_title(7) == "Product #7"
+    assert count("SELECT COUNT(*) FROM users") == 20
+    assert count("SELECT COUNT(*) FROM products") == 50
+
+
+def test_running_refresher_picks_up_changes(stub):
+    mirror = refresher(interval=0.05)
+    mirror.start()
+    try:
+        stub.products[7] = {**stub.products[7], 'title': "Renamed"}
+
+        deadline = time.monotonic() + 5
+        while mirrored_title(7) != "Renamed" and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert mirrored_title(7) == "Renamed"
+    finally:
+        mirror.stop()
+        mirror.join()
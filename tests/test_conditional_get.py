@@ -0,0 +1,35 @@
+import pytest
+
+import shopping_cart
+
+
+@pytest.mark.parametrize('path', ['/cart/user/1', '/cart/user/1/summary'])
+def test_unchanged_cart_is_not_modified(client, stub, path):
+    assert client.post('/cart/user/1/product/1').status_code == 201
+    etag = client.get(path).headers['ETag']
+
+    response = client.get(path, headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+@pytest.mark.parametrize('path', ['/cart/user/1', '/cart/user/1/summary'])
+def test_removed_user_isnt_revalidated(client, stub, path):
+    assert client.post('/cart/user/1/product/1').status_code == 201
+    etag = client.get(path).headers['ETag']
+
+    del stub.users[1]
+    shopping_cart.user_cache.invalidate(1)
+
+    assert client.get(path, headers={'If-None-Match': etag}).status_code == 404
+
+
+@pytest.mark.parametrize('path', ['/cart/user/1', '/cart/user/1/summary'])
+def test_deleted_cart_isnt_revalidated(client, stub, path):
+    assert client.post('/cart/user/1/product/1').status_code == 201
+    etag = client.get(path).headers['ETag']
+
+    assert client.delete('/cart/user/1').status_code == 204
+
+    assert client.get(path, headers={'If-None-Match': etag}).status_code == 404
@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+import migrations
+from migrations import LATEST_VERSION, MigrationFailedException, migrate
+from shopping_cart import db
+from storage import configure_engine
+
+# Schema of the shopping_cart_db.sqlite3 files written before the migrations existed
+BASELINE_SCHEMA = """
+CREATE TABLE shopping_cart (
+    id INTEGER NOT NULL,
+    user_id INTEGER,
+    username VARCHAR,
+    product_id INTEGER,
+    product_title VARCHAR,
+    product_desc VARCHAR,
+    product_price INTEGER,
+    quantity INTEGER,
+    auto_date DATETIME,
+    PRIMARY KEY (id)
+)
+"""
+
+# (id, user_id, username, product_id, product_title, product_desc, product_price, quantity, auto_date)
+# Product #5 is in two carts as the same snapshot, product #4 was renamed between its two lines
+BASELINE_LINES = [
+    (1, 10, 'jimmie_k', 5, "Bracelet", "Naga dragon", 695, 3, '2023-02-03 11:33:04.505725'),
+    (3, 5, 'derek', 4, "Mens Casual Slim Fit", "Color may vary", 15.99, 2, '2023-02-03 11:33:07.020502'),
+    (4, 5, 'derek', 5, "Bracelet", "Naga dragon", 695, 1, '2023-02-03 11:33:08.000000'),
+    (7, 2, 'mor_2314', 4, "Mens Casual Fit", "Color may vary", 15.99, 5, '2023-02-04 09:00:00.000000'),
+]
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    """
+     Path and engine of a database with the baseline schema and lines
+    """
+    path = str(tmp_path / 'shopping_cart_db.sqlite3')
+    with sqlite3.connect(path) as conn:
+        conn.execute(BASELINE_SCHEMA)
+        conn.executemany("INSERT INTO shopping_cart VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", BASELINE_LINES)
+
+    engine = create_engine(f"sqlite:///{path}")
+    configure_engine(engine, 'default')
+    yield path, engine
+    engine.dispose()
+
+
+def lines(path: str) -> list:
+    with sqlite3.connect(path) as conn:
+        return conn.execute(
+            "SELECT c.id, c.user_id, c.product_id, s.title, s.description, s.price, c.quantity, c.auto_date "
+            "FROM shopping_cart c JOIN product_snapshots s ON s.id = c.snapshot_id ORDER BY c.id"
+        ).fetchall()
+
+
+def test_baseline_lines_are_kept_with_deduplicated_snapshots(baseline):
+    path, engine = baseline
+
+    report = migrate(engine, db.metadata)
+
+    assert report['from_version'] == 0 and report['to_version'] == LATEST_VERSION
+    assert lines(path) == [(id, user_id, product_id, title, description, price, quantity, auto_date)
+                           for id, user_id, _, product_id, title, description, price, quantity, auto_date in BASELINE_LINES]
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == LATEST_VERSION
+        assert conn.execute("SELECT COUNT(*) FROM product_snapshots").fetchone()[0] == 3
+        assert conn.execute("SELECT COUNT(*) FROM product_snapshots WHERE product_id = 5").fetchone()[0] == 1
+        assert conn.execute("SELECT item_count, total_quantity, total_cents FROM cart_totals WHERE user_id = 5").fetchone() == (2, 3, 72698)
+
+
+def test_migrated_database_isnt_touched_again(baseline):
+    path, engine = baseline
+    migrate(engine, db.metadata)
+    before = lines(path)
+
+    report = migrate(engine, db.metadata)
+
+    assert report['from_version'] == report['to_version'] == LATEST_VERSION
+    assert 'size_after' not in report
+    assert lines(path) == before
+
+
+def test_lines_without_a_snapshot_abort_the_migration(baseline, monkeypatch):
+    path, engine = baseline
+    # Both names of product #4 get the same hash, only one snapshot is kept and a line can't be matched
+    monkeypatch.setattr(migrations, 'snapshot_hash', lambda title, description, price: 'same')
+
+    with pytest.raises(MigrationFailedException):
+        migrate(engine, db.metadata)
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+        assert conn.execute("SELECT * FROM shopping_cart ORDER BY id").fetchall() == BASELINE_LINES
+        assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall() == [('shopping_cart',)]
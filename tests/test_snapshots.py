@@ -0,0 +1,45 @@
+from shopping_cart import app, db
+
+
+def snapshots() -> set:
+    """
+     Products that have a snapshot
+    """
+    with app.app_context(), db.engine.connect() as conn:
+        return set(conn.exec_driver_sql("SELECT product_id FROM product_snapshots").scalars())
+
+
+def test_removing_a_line_deletes_its_unused_snapshot(client, stub):
+    for user_id, product_id in ((1, 1), (1, 2), (2, 1)):
+        assert client.post(f'/cart/user/{user_id}/product/{product_id}').status_code == 201
+    assert snapshots() == {1, 2}
+
+    # Product #1 is still in user #2's cart
+    assert client.delete('/cart/user/1/product/1').status_code == 204
+    assert client.delete('/cart/user/1/product/2').status_code == 204
+    assert snapshots() == {1}
+
+    assert client.delete('/cart/user/2/product/1').status_code == 204
+    assert snapshots() == set()
+
+
+def test_batch_remove_deletes_unused_snapshots(client, stub):
+    assert client.post('/cart/user/1/batch', json={'operations': [
+        {'op': 'add', 'product_id': 1}, {'op': 'add', 'product_id': 2}, {'op': 'add', 'product_id': 3},
+    ]}).status_code == 200
+    assert client.post('/cart/user/2/product/3').status_code == 201
+
+    response = client.post('/cart/user/1/batch', json={'operations': [
+        {'op': 'remove', 'product_id': 1}, {'op': 'remove', 'product_id': 3},
+    ]})
+
+    assert [result['status'] for result in response.get_json()['results']] == [204, 204]
+    assert snapshots() == {2, 3}
+
+
+def test_deleting_a_cart_deletes_its_unused_snapshots(client, stub):
+    for user_id, product_id in ((1, 1), (1, 2), (2, 2)):
+        assert client.post(f'/cart/user/{user_id}/product/{product_id}').status_code == 201
+
+    assert client.delete('/cart/user/1').status_code == 204
+    assert snapshots() == {2}
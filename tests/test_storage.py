@@ -0,0 +1,34 @@
+import threading
+import time
+
+import shopping_cart
+from conftest import count
+from shopping_cart import app
+
+
+def test_reads_waiting_on_the_catalog_dont_block_writes(client, stub):
+    for user_id in (1, 2):
+        assert client.post(f'/cart/user/{user_id}/product/1').status_code == 201
+
+    # User #2 and product #1 are cached now, only the GET of user #1 goes to the (slow) catalog
+    shopping_cart.user_cache.invalidate(1)
+    stub.latency_ms = 1500
+    requests        = stub.requests
+
+    responses = {}
+    reader    = threading.Thread(target=lambda: responses.update(get=app.test_client().get('/cart/user/1')))
+    reader.start()
+
+    while stub.requests == requests:
+        time.sleep(0.01)
+
+    started = time.monotonic()
+    put     = client.put('/cart/user/2/product/1', json={'quantity': 4})
+    elapsed = time.monotonic() - started
+
+    assert put.status_code == 200
+    assert reader.is_alive(), f"the PUT waited {elapsed:.2f}s for the GET to end"
+
+    reader.join()
+    assert responses['get'].status_code == 200
+    assert count("SELECT quantity FROM shopping_cart WHERE user_id = 2") == 4
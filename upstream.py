@@ -0,0 +1,176 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class UpstreamUnavailableException(Exception):
+    """
+     Raised when the external API can't be reached, times out or the circuit breaker is open
+    """
+    pass
+
+
+class CircuitBreaker():
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+         Open the circuit after `failure_threshold` consecutive failures and let a
+         single trial call through once `reset_timeout` seconds have passed
+        """
+        self._failure_threshold = failure_threshold
+        self._reset_timeout     = reset_timeout
+
+        self._failures          = 0
+        self._opened_at         = None
+        self._trial_running     = False
+        self._lock              = threading.Lock()
+
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self._reset_timeout:
+                return 'half-open'
+            return 'open'
+
+
+    def allow(self) -> bool:
+        """
+         Whether a call may go out right now
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if time.monotonic() - self._opened_at < self._reset_timeout or self._trial_running:
+                return False
+
+            self._trial_running = True
+            return True
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures      = 0
+            self._opened_at     = None
+            self._trial_running = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures     += 1
+            self._trial_running = False
+
+            if self._opened_at is not None or self._failures >= self._failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class UpstreamClient():
+    def __init__(self, name: str, pool_size: int = 20, connect_timeout: float = 3.05, read_timeout: float = 10,
+                 retries: int = 2, backoff_factor: float = 0.2, breaker: CircuitBreaker = None):
+        """
+         Shared keep-alive HTTP client for an external API
+
+         Idempotent GETs are retried with exponential backoff on connection errors and 502/503/504,
+         every call is bounded by the connect/read timeouts.
+        """
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.name     = name
+        self.timeout  = (connect_timeout, read_timeout)
+        self.breaker  = breaker or CircuitBreaker()
+
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=f"{name}-upstream")
+
+
+    def get(self, url: str) -> requests.Response:
+        """
+         GET `url` through the pool
+
+         @throws UpstreamUnavailable
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailableException(f"The {self.name} API is currently unavailable, please try again later!")
+
+        try:
+            r = self._session.get(url, timeout=self.timeout)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise UpstreamUnavailableException(f"The {self.name} API is currently unavailable, please try again later!")
+
+        if r.status_code >= 500:
+            self.breaker.record_failure()
+            raise UpstreamUnavailableException(f"The {self.name} API is currently unavailable, please try again later!")
+
+        self.breaker.record_success()
+        return r
+
+
+    def submit(self, fn, *args):
+        """
+         Run `fn(*args)` on the client's worker pool and return its future
+
+         It runs in a copy of the caller's context, so per-request state (e.g. metrics) follows it.
+        """
+        return self._executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class AsyncUpstreamClient():
+    def __init__(self, name: str, pool_size: int = 100, connect_timeout: float = 3.05, read_timeout: float = 10,
+                 retries: int = 2, breaker: CircuitBreaker = None):
+        """
+         Non-blocking counterpart of UpstreamClient, used by the ASGI app
+
+         Connection errors are retried by the transport, every call is bounded by the connect/read timeouts.
+        """
+        import httpx
+
+        self._httpx   = httpx
+        self.name     = name
+        self.breaker  = breaker or CircuitBreaker()
+
+        self._client  = httpx.AsyncClient(
+            transport = httpx.AsyncHTTPTransport(retries=retries),
+            limits    = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout   = httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+
+    async def get(self, url: str):
+        """
+         GET `url` through the pool
+
+         @throws UpstreamUnavailable
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailableException(f"The {self.name} API is currently unavailable, please try again later!")
+
+        try:
+            r = await self._client.get(url)
+        except self._httpx.HTTPError:
+            self.breaker.record_failure()
+            raise UpstreamUnavailableException(f"The {self.name} API is currently unavailable, please try again later!")
+
+        if r.status_code >= 500:
+            self.breaker.record_failure()
+            raise UpstreamUnavailableException(f"The {self.name} API is currently unavailable, please try again later!")
+
+        self.breaker.record_success()
+        return r
+
+
+    async def aclose(self):
+        await self._client.aclose()